@@ -1,105 +1,97 @@
+import argparse
+import io
+import json
+import marshal
+import os
 import sys
-import opcodes as opcodes_file
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from wapp_tools import opcodes as opcodes_file
+from wapp_tools.utils import ContentCache, expandPaths
+from wapp_tools.wapp_file import WappFile, WappFileError, DIRECTORY
 
 
-class Disassembler:
-    def __init__(self, executable_path) -> None:
-        self.executable_path = executable_path
-        self.executable_file = None
-
-    def read_int(self, byte_count=4):
-        bts = self.executable_file.read(byte_count)
-        return int.from_bytes(bts, 'little')
+SNAPSHOT_HEADER = struct.Struct('<4sIIIII')     # signature, version, global flags, literal table start, function count, function start
+FUNCTION_HEADER = struct.Struct('<HHHBBBBBB')   # size >> 3, refs, flags, stack limit, argument/register/identifier/const literal/literal range ends
+LITERAL_SIZE = struct.Struct('<H')
 
-    def skip_zeros(self):
-        if self.executable_file.tell() == self.file_size: return
 
-        while self.executable_file.read(1) == b'\x00':
-            pass
-        self.executable_file.seek(-1, 1)
+class Disassembler:
+    # the snapshot is parsed from an in-memory buffer (bytes, bytearray or memoryview),
+    # if only executable_path is given, the whole file is read by parse()
+    def __init__(self, executable_path=None, buffer=None) -> None:
+        self.executable_path = executable_path
+        self.buffer = buffer
 
-    def read_short(self):
-        return self.read_int(2)
+    def skip_zeros(self, position):
+        if position == self.file_size: return position
 
-    def read_byte(self):
-        return self.read_int(1)
+        while position < self.file_size and self.buffer[position] == 0:
+            position += 1
+        if position == self.file_size:
+            position -= 1   # zeros up to the end, stop at the last byte as the file based reader did
+        return position
 
-    def read_literal(self):
-        size = self.read_short()
-        literal = self.executable_file.read(size)
+    def read_literal(self, address):
+        size = LITERAL_SIZE.unpack_from(self.buffer, address)[0]
+        literal = bytes(self.buffer[address + 2:address + 2 + size])
         return literal
 
-    def print_bytes(self, bts):
-        for b in bts:
-            print('%.2X ' % b, end='')
-
-    def print_int(self, value, comment='', count=4, newline=True):
-        print('%s ' % comment, end='')
-        bts = value.to_bytes(count, 'little')
-        self.print_bytes(bts)
-        if newline:
-            print()
-
-    def print_short(self, value, comment=''):
-        self.print_int(value, comment, count=2)
-
-    def print_byte(self, value, comment=''):
-        self.print_int(value, comment, count=1)
+    # literal table offset => decoded string, every string is read once and the same object is shared by all functions.
+    # The table also holds numbers which can't be told apart from strings without a reference, so it's filled on demand.
+    def table_literal(self, offset):
+        literal = self.literal_table.get(offset)
+        if literal is None:
+            literal = self.read_literal(self.literal_table_start + offset)
+            literal = self.interned_literals.setdefault(literal, literal)
+            self.literal_table[offset] = literal
+        return literal
 
     def literal_is_offset(self, pointer):
         return (pointer & 0x07) == 0x07
 
-    def read_function(self):
-        function_start = self.executable_file.tell()
-        function_size = self.read_short() << 3
-        refs = self.read_short()
-        flags = self.read_short()
-        stack_limit = self.read_byte()
-        argument_range_end = self.read_byte()
-        register_range_end = self.read_byte()
-        identifier_range_end = self.read_byte()
-        const_literal_range_end = self.read_byte()
-        literal_range_end = self.read_byte()
+    def read_function(self, function_start):
+        (function_size, refs, flags, stack_limit, argument_range_end, register_range_end, identifier_range_end,
+            const_literal_range_end, literal_range_end) = FUNCTION_HEADER.unpack_from(self.buffer, function_start)
+        function_size <<= 3
         literal_count = literal_range_end - register_range_end
+        position = function_start + FUNCTION_HEADER.size
 
         identifiers = []
         const_literals = []
         literals = []
 
         def append_literals(count, literal_list):
-            for i in range(count):
-                identifier_pointer = self.read_int()
-                value = 'not offset'
+            nonlocal position
+            for identifier_pointer in struct.unpack_from('<%iI' % max(count, 0), self.buffer, position):
                 if self.literal_is_offset(identifier_pointer):
                     if (identifier_pointer & 0x8) != 0:
                         value = 'number'
                     else:
-                        current_pos = self.executable_file.tell()
-                        address = self.literal_table_start + (identifier_pointer >> 4)
-                        self.executable_file.seek(address)
-                        value = self.read_literal()
-                        self.executable_file.seek(current_pos)
+                        value = self.table_literal(identifier_pointer >> 4)
                 else:
                     value = 'num %i' % (identifier_pointer >> 4)
                 literal_list.append({
                     'address': identifier_pointer,
                     'value': value
                 })
+            position += 4 * len(literal_list)
 
         append_literals(identifier_range_end - register_range_end, identifiers)
         append_literals(const_literal_range_end - identifier_range_end, const_literals)
 
-        for i in range(const_literal_range_end, literal_range_end):
-            literal = self.read_int()
+        for literal in struct.unpack_from('<%iI' % max(literal_range_end - const_literal_range_end, 0), self.buffer, position):
             literals.append({
                 'address': literal,
                 'value': 'literal %.2X %.2X %.2X %.2X' % tuple(literal.to_bytes(4, 'little'))
             })
+        position += 4 * len(literals)
 
-        code_start = self.executable_file.tell()
+        code_start = position
         header_size = code_start - function_start
         code_size = function_size - header_size
-        code = self.executable_file.read(code_size)
+        code = bytes(self.buffer[code_start:code_start + max(code_size, 0)])
 
         function = {
             'name': 'unknown',
@@ -120,171 +112,722 @@ class Disassembler:
             'code': code
         }
 
-        self.executable_file.seek(function_start + function_size, 0)
-        self.skip_zeros()
-        return function
+        return function, self.skip_zeros(function_start + function_size)
 
     def resolve_function_literals(self, functions):
         for function in functions:
             for literal in function['literals']:
-                address = literal['address'] + self.function_start
-                function_index = 0
-                for function2 in functions:
-                    if address == function2['start']:
-                        literal['value'] = 'function %i' % function_index
-                    function_index = function_index + 1
-
-    def decode_code(self, function, functions, only_scan_function_names):
+                function_index = self.index.function_at(literal['address'])
+                if function_index is not None:
+                    literal['value'] = 'function %i' % function_index
+
+    # decodes the code of a function into a list of instructions in a single pass
+    def decode_instructions(self, function):
         code = function['code']
-        opcodes = opcodes_file.opcodes
-        opcodes_ext = opcodes_file.opcodes_ext
+        code_size = len(code)
+        dispatch = opcodes_file.DISPATCH
+        instructions = []
+        append = instructions.append
         index = 0
-        if not only_scan_function_names:
-            print('// disassembly')
 
-        while index < code.__len__():
+        while index < code_size:
             opcode = code[index]
-            opcode_data = opcodes[opcode]
+            key = opcode
             if opcode == 0:
                 index = index + 1
-                if index >= code.__len__():
-                    return
+                if index >= code_size:
+                    break
                 opcode = code[index]
                 if opcode == 0x00:
                     continue # noop, mostl at end of functions (as padding i suppose)
-                try:
-                    opcode_data = opcodes_ext[opcode]
-                except KeyError:
-                    pass
-            name = opcode_data['name']
-            if name == 'CBC_PUSH_THREE_LITERALS':
-                opcode_data['literal_args'] = 3
+                key = opcodes_file.EXT_PLANE + opcode
 
-            literals = function['identifiers'] + function['const_literals'] + function['literals']
-
-            if only_scan_function_names:
-                if name == 'CBC_INITIALIZE_VAR':
-                    try:
-                        referenced_func_name = literals[code[index + 1] - function['register_range_end']]['value']
-                        referenced_func_address = literals[code[index + 2] - function['register_range_end']]['address'] + self.function_start
-                        for function in functions:
-                            if referenced_func_address == function['start']:
-                                try:
-                                    function['name'] = referenced_func_name.decode('ascii')
-                                except:
-                                    function['name'] = 'cannot decode'
-                                break
-                    except:
-                        print('error decoding reference')
-                index = index + 1 + opcode_data['literal_args'] + opcode_data['byte_args'] + opcode_data['branch_args']
-                continue
+            name, literals_end, bytes_end, branches_end = dispatch[key]
 
-            print('%i  %.2X: %s  ' % (index, opcode, name), end='')
-            opcode_index = index
-
-            for i in range(opcode_data['literal_args']):
+            if branches_end == 1:
+                append(Instruction(index, opcode, key != opcode, name, (), (), (), False))
                 index = index + 1
-                identifier_index = code[index]
-                print('lit %.2X ' % (identifier_index), end='')
-                if identifier_index < function['argument_range_end']:
-                    print('(arg %i)   ' % identifier_index, end='')
-                elif identifier_index < function['register_range_end']:
-                    print('(register %i)   ' % (identifier_index - function['argument_range_end']), end='')
-                else:
-                    print('(literal %s)   ' % (literals[identifier_index - function['register_range_end']]['value']), end='')
+                continue
 
+            append(Instruction(index, opcode, key != opcode, name,
+                tuple(code[index + 1:index + literals_end]), tuple(code[index + literals_end:index + bytes_end]),
+                tuple(code[index + bytes_end:index + branches_end]), index + branches_end > code_size))
+            index = index + branches_end
 
-            for i in range(opcode_data['byte_args']):
-                index = index + 1
-                arg = code[index]
-                print('byte(%.2X  number: %i) ' % (arg, arg + 1), end='')
+        return instructions
 
-            for i in range(opcode_data['branch_args']):
-                index = index + 1
+    def resolve_function_names(self, functions):
+        for function in functions:
+            literals = function['identifiers'] + function['const_literals'] + function['literals']
+            for instruction in function['instructions']:
+                if instruction.name != 'CBC_INITIALIZE_VAR':
+                    continue
                 try:
-                    arg = code[index]
-                    print('branch(%.2X  number: %i  address: %i) ' % (arg, arg, opcode_index + arg), end='')
+                    referenced_func_name = literals[instruction.literals[0] - function['register_range_end']]['value']
+                    referenced_function = self.index.function_at(literals[instruction.literals[1] - function['register_range_end']]['address'])
+                    if referenced_function is not None:
+                        try:
+                            functions[referenced_function]['name'] = referenced_func_name.decode('ascii')
+                        except:
+                            functions[referenced_function]['name'] = 'cannot decode'
                 except:
-                    print('error decoding range', file=sys.stderr)
-                    pass
+                    print('error decoding reference', file=sys.stderr)
+
+    # parses the snapshot into a list of functions with decoded instructions
+    def parse(self):
+        if self.buffer is None:
+            with open(self.executable_path, 'rb') as executable_file:
+                self.buffer = executable_file.read()
+
+        self.file_size = len(self.buffer)
+
+        (signature, version, global_flags, literal_table_start, function_count,
+            function_start) = SNAPSHOT_HEADER.unpack_from(self.buffer, 0)
+        if signature != b'JRRY':
+            raise Exception('file is does not start with jerry signature')
+        if version != 0x18:
+            raise Exception('file version is not supported')
+        self.literal_table_start = literal_table_start
+        self.function_start = function_start
+        self.literal_table = {}
+        self.interned_literals = {}
+
+        functions = []
+
+        position = function_start
+        while position < literal_table_start:
+            function, position = self.read_function(position)
+            function['instructions'] = self.decode_instructions(function)
+            functions.append(function)
+
+        self.index = SnapshotIndex(functions, function_start)
+        self.resolve_function_names(functions)
+        self.resolve_function_literals(functions)
+        self.index.index_names()
+
+        return functions
 
-            print()
+    def start(self):
+        render_text(self.parse(), sys.stdout)
+
+
+# Cross-reference index of a parsed snapshot, built once. Users are (function index, instruction offset) pairs.
+# Callees of a function are functions it references by function literals or by identifiers with their name.
+class SnapshotIndex:
+    def __init__(self, functions, function_start):
+        self.functions = functions
+        self.function_start = function_start
+        self.function_by_start = {function['start']: i for i, function in enumerate(functions)}
+        self.literal_users = {}     # string (bytes) or address (int) of a literal => users
+        self.function_users = {}    # function index => users
+        self.function_by_name = {}  # name => function indexes
+        self.callees = {}
+        self.callers = {}
+
+        for function_index, function in enumerate(functions):
+            literals = function['identifiers'] + function['const_literals'] + function['literals']
+            literal_functions = [self.function_at(literal['address']) for literal in function['literals']]
+            first_function_literal = len(function['identifiers']) + len(function['const_literals'])
+            register_range_end = function['register_range_end']
+
+            for instruction in function['instructions']:
+                user = (function_index, instruction.offset)
+                for identifier_index in instruction.literals:
+                    literal_index = identifier_index - register_range_end
+                    if literal_index < 0 or literal_index >= len(literals):
+                        continue
+                    self.literal_users.setdefault(self.literal_key(literals[literal_index]), []).append(user)
+                    if literal_index >= first_function_literal:
+                        referenced = literal_functions[literal_index - first_function_literal]
+                        if referenced is not None:
+                            self.function_users.setdefault(referenced, []).append(user)
+
+    @staticmethod
+    def literal_key(literal):
+        return literal['value'] if isinstance(literal['value'], bytes) else literal['address']
+
+    # index of the function referenced by a function literal address, None if there is no such function
+    def function_at(self, literal_address):
+        return self.function_by_start.get(literal_address + self.function_start)
+
+    # call graph, needs function names, so it's built after they are resolved
+    def index_names(self):
+        self.function_by_name = {}
+        for i, function in enumerate(self.functions):
+            if i != 0 and function['name'] not in ('unknown', 'cannot decode'):
+                self.function_by_name.setdefault(function['name'].encode('ascii'), []).append(i)
+        self.callees = {i: set() for i in range(len(self.functions))}
+        self.callers = {i: set() for i in range(len(self.functions))}
+
+        def add_call(caller, callee):
+            self.callees[caller].add(callee)
+            self.callers[callee].add(caller)
+
+        for callee, users in self.function_users.items():
+            for caller, _offset in users:
+                add_call(caller, callee)
+        for name, callees in self.function_by_name.items():
+            for caller, _offset in self.literal_users.get(name, ()):
+                for callee in callees:
+                    add_call(caller, callee)
+
+    def users_of_literal(self, literal):
+        return self.literal_users.get(literal, [])
+
+    def users_of_function(self, function_index):
+        return self.function_users.get(function_index, [])
+
+    # string literal => number of uses
+    def string_usage(self):
+        return {key: len(users) for key, users in self.literal_users.items() if isinstance(key, bytes)}
+
+
+class Instruction:
+    __slots__ = ('offset', 'opcode', 'extended', 'name', 'literals', 'bytes', 'branches', 'truncated')
+
+    def __init__(self, offset, opcode, extended, name, literals, bytes, branches, truncated):
+        self.offset = offset        # offset of the opcode (of the second byte for extended opcodes)
+        self.opcode = opcode
+        self.extended = extended
+        self.name = name
+        self.literals = literals    # literal indexes
+        self.bytes = bytes
+        self.branches = branches
+        self.truncated = truncated  # code ended in the middle of the arguments
+
+    def to_tuple(self):
+        return (self.offset, self.opcode, self.extended, self.name, self.literals, self.bytes, self.branches, self.truncated)
+
+
+def _hex_bytes(bts):
+    return ''.join('%.2X ' % b for b in bts)
+
+
+def render_text(functions, out):
+    lines = []
+
+    def int_line(comment, value, count):
+        return '%s %s' % (comment, _hex_bytes(value.to_bytes(count, 'little')))
+
+    for function_index, function in enumerate(functions):
+        if function_index == 0:
+            lines.append('// function %i (main code)' % function_index)
+        else:
+            lines.append('// function %i  "%s"' % (function_index, function['name']))
+        lines.append(int_line('start:', function['start'], 2))
+        lines.append(int_line('size:', function['size'] >> 3, 2))
+        lines.append(int_line('refs:', function['refs'], 2))
+        lines.append(int_line('flags:', function['flags'], 2))
+
+        lines.append(int_line('stack depth:', function['stack_limit'], 1))
+        for field in ('argument_range_end', 'register_range_end', 'identifier_range_end', 'const_literal_range_end', 'literal_range_end'):
+            lines.append(int_line(field + ':', function[field], 1))
+
+        for header, key in (('// identifiers', 'identifiers'), ('// const literals', 'const_literals'), ('// literals', 'literals')):
+            lines.append(header)
+            for i, identifier in enumerate(function[key]):
+                lines.append('%i %s: %s' % (i, _hex_bytes(identifier['address'].to_bytes(4, 'little')), identifier['value']))
+
+        lines.append('// code')
+        lines.append(_hex_bytes(function['code']))
+        lines.append('// disassembly')
+
+        literals = function['identifiers'] + function['const_literals'] + function['literals']
+        argument_range_end = function['argument_range_end']
+        register_range_end = function['register_range_end']
+
+        for instruction in function['instructions']:
+            line = ['%i  %.2X: %s  ' % (instruction.offset, instruction.opcode, instruction.name)]
+
+            for identifier_index in instruction.literals:
+                line.append('lit %.2X ' % identifier_index)
+                if identifier_index < argument_range_end:
+                    line.append('(arg %i)   ' % identifier_index)
+                elif identifier_index < register_range_end:
+                    line.append('(register %i)   ' % (identifier_index - argument_range_end))
+                elif identifier_index - register_range_end < len(literals):
+                    line.append('(literal %s)   ' % literals[identifier_index - register_range_end]['value'])
+                else:
+                    line.append('(literal invalid)   ')
+
+            for arg in instruction.bytes:
+                line.append('byte(%.2X  number: %i) ' % (arg, arg + 1))
+
+            for arg in instruction.branches:
+                line.append('branch(%.2X  number: %i  address: %i) ' % (arg, arg, instruction.offset + arg))
+
+            if instruction.truncated:
+                print('error decoding range', file=sys.stderr)
+
+            lines.append(''.join(line))
+
+        lines.append('')
+        lines.append('')
+
+    if lines:
+        out.write('\n'.join(lines) + '\n')
+
+
+def render_xref(functions, index, out):
+    lines = []
+    for function_index, function in enumerate(functions):
+        lines.append('// function %i  "%s"' % (function_index, function['name']))
+        lines.append('callers: %s' % ' '.join(str(i) for i in sorted(index.callers.get(function_index, ()))))
+        lines.append('callees: %s' % ' '.join(str(i) for i in sorted(index.callees.get(function_index, ()))))
+    lines.append('// strings')
+    for string, count in sorted(index.string_usage().items(), key=lambda item: (-item[1], item[0])):
+        users = index.users_of_literal(string)
+        lines.append('%i %s: %s' % (count, string, ' '.join('%i@%i' % user for user in users)))
+    out.write('\n'.join(lines) + '\n')
+
+
+# size and hot-spot statistics of parsed snapshots, scripts is a list of (name, disassembler, functions)
+def profile(scripts):
+    total_size = 0
+    literal_table_size = 0
+    padding = 0
+    function_rows = []
+    opcodes = {}
+    literal_copies = {}     # string => number of copies in literal tables
+
+    for name, disassembler, functions in scripts:
+        total_size += disassembler.file_size
+        literal_table_size += disassembler.file_size - disassembler.literal_table_start
+        for literal in disassembler.literal_table.values():
+            literal_copies[literal] = literal_copies.get(literal, 0) + 1
+
+        for function_index, function in enumerate(functions):
+            # zeros skipped between the end of a function and the next one (or the literal table)
+            end = functions[function_index + 1]['start'] if function_index + 1 < len(functions) else disassembler.literal_table_start
+            function_padding = max(end - function['start'] - function['size'], 0)
+            padding += function_padding
+
+            function_rows.append({
+                'script': name,
+                'index': function_index,
+                'name': function['name'],
+                'size': function['size'],
+                'header_size': function['code_start'] - function['start'],
+                'code_size': len(function['code']),
+                'padding': function_padding,
+                'instructions': len(function['instructions']),
+                'literals': function['literal_range_end'] - function['register_range_end'],
+                'stack_limit': function['stack_limit'],
+            })
+
+            starts = [i.offset - i.extended for i in function['instructions']] + [len(function['code'])]
+            for i, instruction in enumerate(function['instructions']):
+                counts = opcodes.setdefault(instruction.name, [0, 0])
+                counts[0] += 1
+                counts[1] += starts[i + 1] - starts[i]
+
+    return {
+        'scripts': len(scripts),
+        'size': total_size,
+        'literal_table_size': literal_table_size,
+        'literal_table_share': literal_table_size / total_size if total_size else 0,
+        'padding': padding,
+        'functions': sorted(function_rows, key=lambda row: -row['size']),
+        'opcodes': sorted(({'name': name, 'count': count, 'bytes': size} for name, (count, size) in opcodes.items()),
+            key=lambda row: (-row['count'], row['name'])),
+        'duplicated_literals': sorted(({'value': _json_value(literal), 'copies': copies, 'wasted': (copies - 1) * (LITERAL_SIZE.size + len(literal))}
+            for literal, copies in literal_copies.items() if copies > 1), key=lambda row: (-row['wasted'], row['value'])),
+        'stack_depths': sorted(function_rows, key=lambda row: -row['stack_limit']),
+    }
+
+
+def render_profile(stats, out, top=20):
+    lines = [
+        'scripts: %i' % stats['scripts'],
+        'size: %i' % stats['size'],
+        'literal table: %i (%.1f%%)' % (stats['literal_table_size'], stats['literal_table_share'] * 100),
+        'padding: %i' % stats['padding'],
+        '',
+        '// largest functions',
+        '%-24s %6s %8s %6s %6s %7s %8s %6s  %s' % ('script', 'index', 'size', 'header', 'code', 'padding', 'instrs', 'stack', 'name'),
+    ]
+    for row in stats['functions'][:top]:
+        lines.append('%-24s %6i %8i %6i %6i %7i %8i %6i  %s' % (row['script'] or '', row['index'], row['size'], row['header_size'],
+            row['code_size'], row['padding'], row['instructions'], row['stack_limit'], row['name']))
+
+    lines += ['', '// opcodes', '%-40s %8s %8s' % ('name', 'count', 'bytes')]
+    for row in stats['opcodes'][:top]:
+        lines.append('%-40s %8i %8i' % (row['name'], row['count'], row['bytes']))
+
+    lines += ['', '// duplicated literals', '%8s %6s  %s' % ('wasted', 'copies', 'value')]
+    for row in stats['duplicated_literals'][:top]:
+        lines.append('%8i %6i  %s' % (row['wasted'], row['copies'], row['value']))
+
+    lines += ['', '// largest stack depths', '%-24s %6s %6s  %s' % ('script', 'index', 'stack', 'name')]
+    for row in stats['stack_depths'][:top]:
+        lines.append('%-24s %6i %6i  %s' % (row['script'] or '', row['index'], row['stack_limit'], row['name']))
+
+    out.write('\n'.join(lines) + '\n')
+
+
+def _json_value(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'backslashreplace')
+    return value
+
+
+def render_json(functions):
+    ret = []
+    for function_index, function in enumerate(functions):
+        item = {'index': function_index}
+        for key, value in function.items():
+            if key in ('identifiers', 'const_literals', 'literals'):
+                value = [{'address': v['address'], 'value': _json_value(v['value'])} for v in value]
+            elif key == 'code':
+                value = value.hex()
+            elif key == 'instructions':
+                value = [{
+                    'offset': i.offset,
+                    'opcode': i.opcode,
+                    'extended': i.extended,
+                    'name': i.name,
+                    'literals': i.literals,
+                    'bytes': i.bytes,
+                    'branches': i.branches,
+                    'truncated': i.truncated
+                } for i in value]
+            item[key] = value
+        ret.append(item)
+    return ret
+
+
+# compact binary cache of parsed functions, it's python version specific (marshal)
+BINARY_CACHE_MAGIC = b'JDIS'
+BINARY_CACHE_VERSION = 1
+
+
+def dump_binary(functions):
+    data = [dict(function, instructions=[i.to_tuple() for i in function['instructions']]) for function in functions]
+    return BINARY_CACHE_MAGIC + struct.pack('<HH', BINARY_CACHE_VERSION, marshal.version) + marshal.dumps(data)
+
+
+def load_binary(buffer):
+    if buffer[:4] != BINARY_CACHE_MAGIC or struct.unpack_from('<HH', buffer, 4) != (BINARY_CACHE_VERSION, marshal.version):
+        raise Exception('unsupported disassembly cache')
+    functions = marshal.loads(buffer[8:])
+    for function in functions:
+        function['instructions'] = [Instruction(*i) for i in function['instructions']]
+    return functions
+
+
+# yields (name, script buffer) of every script in a .wapp file, buffers are views into the file
+def wapp_scripts(wapp_path):
+    with open(wapp_path, 'rb') as f:
+        wapp = WappFile(fh=f, readOnly=True)
+    for entry in wapp.getDirectory(DIRECTORY.SCRIPT):
+        yield entry.file_name, entry.content
+
+
+OUTPUT_EXTENSIONS = {'text': '.txt', 'json': '.json', 'binary': '.bin', 'xref': '.xref.txt'}
+DISASSEMBLER_VERSION = 1    # bump when the output changes, invalidates cached batch results
+
+
+# renders one parsed script into bytes of the given output format
+def render(functions, index, output_format):
+    if output_format == 'binary':
+        return dump_binary(functions)
+    if output_format == 'json':
+        return (json.dumps(render_json(functions), indent=1) + '\n').encode('utf-8')
+
+    out = io.StringIO()
+    if output_format == 'xref':
+        render_xref(functions, index, out)
+    else:
+        render_text(functions, out)
+    return out.getvalue().encode('utf-8')
+
+
+def _batch_job(job):
+    (content, output_format) = job
+    try:
+        disassembler = Disassembler(buffer=content)
+        functions = disassembler.parse()
+        stats = {
+            'functions': len(functions),
+            'instructions': sum(len(function['instructions']) for function in functions),
+        }
+        return (True, stats, render(functions, disassembler.index, output_format))
+    except Exception as e:
+        return (False, str(e) or type(e).__name__, None)
+
+
+# disassembles all scripts of .wapp files into output_dir/<wapp>/<script><ext> and writes output_dir/index.json
+def batch(args):
+    ext = OUTPUT_EXTENSIONS[args.format]
+    cache = ContentCache(args.cache, args.cache_size) if args.cache else None
+
+    scripts = []
+    failed = 0
+    for src, rel in expandPaths(args.input_file, ['.wapp']):
+        try:
+            for name, content in wapp_scripts(src):
+                scripts.append((src, rel, name, bytes(content)))
+        except Exception as e:
+            failed += 1
+            print('FAILED %s: %s' % (src, str(e) or type(e).__name__))
+
+    # packages with the same file name or scripts with the same name would overwrite each other's output
+    targets = []
+    outputs = {}
+    for src, rel, name, content in scripts:
+        dst = os.path.join(args.output, os.path.splitext(rel)[0], name.replace(os.sep, '_') + ext)
+        key = os.path.normcase(os.path.abspath(dst))
+        if key in outputs:
+            print('ERROR: %s:%s and %s:%s have the same output file %s' % (outputs[key] + (src, name, dst)))
+            sys.exit(1)
+        outputs[key] = (src, name)
+        targets.append((src, name, content, dst))
+
+    index = []
+    jobs = []
+    for src, name, content, dst in targets:
+        key = ContentCache.key(content, format=args.format, version=DISASSEMBLER_VERSION)
+        entry = {'wapp': src, 'script': name, 'size': len(content), 'key': key, 'output': dst}
+        index.append(entry)
+
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            (entry['stats'], output) = marshal.loads(cached)
+            entry['cached'] = True
+            write_output(dst, output)
+            print('CACHED %s:%s -> %s' % (src, name, dst))
+        else:
+            entry['cached'] = False
+            jobs.append((entry, content))
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(_batch_job, ((content, args.format) for _entry, content in jobs), chunksize=4)
+        for (entry, _content), (ok, stats, output) in zip(jobs, results):
+            if ok:
+                entry['stats'] = stats
+                write_output(entry['output'], output)
+                if cache:
+                    cache.put(entry['key'], marshal.dumps((stats, output)))
+                print('OK     %s:%s -> %s' % (entry['wapp'], entry['script'], entry['output']))
+            else:
+                failed += 1
+                entry['error'] = stats
+                entry['output'] = None
+                print('FAILED %s:%s: %s' % (entry['wapp'], entry['script'], stats))
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1)
+        f.write('\n')
+
+    if cache:
+        cache.prune()
+
+    print('\nScripts: %i, cached: %i, disassembled: %i, failed: %i' %
+        (len(index), len(index) - len(jobs), sum(1 for entry, _content in jobs if entry['output']), failed))
+
+    if failed:
+        sys.exit(1)
+
+
+def write_output(path, output):
+    os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(output)
+
+
+# per-instruction dict lookups of the opcode tables, as done before DISPATCH, kept as the baseline of the benchmark
+def _dict_decode_instructions(function):
+    code = function['code']
+    code_size = len(code)
+    opcodes = opcodes_file.opcodes
+    opcodes_ext = opcodes_file.opcodes_ext
+    instructions = []
+    index = 0
+
+    while index < code_size:
+        opcode = code[index]
+        extended = False
+        opcode_data = opcodes.get(opcode, opcodes_file.UNKNOWN_OPCODE)
+        if opcode == 0:
             index = index + 1
+            if index >= code_size:
+                break
+            opcode = code[index]
+            if opcode == 0x00:
+                continue
+            extended = True
+            opcode_data = opcodes_ext.get(opcode, opcode_data)
+        name = opcode_data['name']
+
+        literals_end = index + 1 + opcode_data['literal_args']
+        bytes_end = literals_end + opcode_data['byte_args']
+        branches_end = bytes_end + opcode_data['branch_args']
+
+        instructions.append(Instruction(index, opcode, extended, name,
+            tuple(code[index + 1:literals_end]), tuple(code[literals_end:bytes_end]),
+            tuple(code[bytes_end:branches_end]), branches_end > code_size))
+        index = branches_end
+
+    return instructions
+
+
+# best time of repeated decoding of all parsed functions and of whole parsing, scripts is a list of (disassembler, functions)
+def benchmark(scripts, repeat):
+    instructions = sum(len(function['instructions']) for _disassembler, functions in scripts for function in functions)
+    print('Scripts: %i, functions: %i, instructions: %i' % (len(scripts), sum(len(functions) for _d, functions in scripts), instructions))
+
+    def best_time(func):
+        best = None
+        for _i in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def decode():
+        for disassembler, functions in scripts:
+            for function in functions:
+                disassembler.decode_instructions(function)
 
-    def start(self):
-        with open(self.executable_path, 'rb') as self.executable_file:
-            self.executable_file.seek(0, 2)
-            file_size = self.executable_file.tell()
-            self.file_size = file_size
-            self.executable_file.seek(0, 0)
-
-            signature = self.executable_file.read(4)
-            if signature != b'JRRY':
-                raise Exception('file is does not start with jerry signature')
-            version = self.read_int()
-            if version != 0x18:
-                raise Exception('file version is not supported')
-            global_flags = self.read_int()
-            literal_table_start = self.read_int()
-            self.literal_table_start = literal_table_start
-            function_count = self.read_int()
-            function_start = self.read_int()
-            self.function_start = function_start
-
-            self.executable_file.seek(function_start)
-
-            functions = []
-
-            while self.executable_file.tell() < literal_table_start:
-                functions.append(self.read_function())
-
-            # self.resolve_function_literals(functions)
-
-            function_index = 0
+    def dict_decode():
+        for _disassembler, functions in scripts:
             for function in functions:
-                start = function['start']
-                self.executable_file.seek(start)
-                if function_index == 0:
-                    print('// function %i (main code)' % function_index)
-                else:
-                    print('// function %i  "%s"' % (function_index, function['name']))
-                function_index = function_index + 1
-                self.print_short(function['start'], 'start:')
-                self.print_short(function['size'] >> 3, 'size:')
-                self.print_short(function['refs'], 'refs:')
-                self.print_short(function['flags'], 'flags:')
-
-                self.print_byte(function['stack_limit'], 'stack depth:')
-                self.print_byte(function['argument_range_end'], 'argument_range_end:')
-                self.print_byte(function['register_range_end'], 'register_range_end:')
-                self.print_byte(function['identifier_range_end'], 'identifier_range_end:')
-                self.print_byte(function['const_literal_range_end'], 'const_literal_range_end:')
-                self.print_byte(function['literal_range_end'], 'literal_range_end:')
-
-                def print_values(header, values):
-                    print(header)
-                    i = 0
-                    for identifier in values:
-                        print(i, end='')
-                        i = i + 1
-                        self.print_int(identifier['address'], newline=False)
-                        print(': %s' % identifier['value'])
-
-                print_values('// identifiers', function['identifiers'])
-                print_values('// const literals', function['const_literals'])
-                print_values('// literals', function['literals'])
-                print('// code')
-                self.print_bytes(function['code'])
-                print()
-                self.decode_code(function, functions, True)
-                self.decode_code(function, functions, False)
-
-                print()
-                print()
-
-            pass
+                _dict_decode_instructions(function)
+
+    def parse():
+        for disassembler, _functions in scripts:
+            Disassembler(buffer=disassembler.buffer).parse()
+
+    for disassembler, functions in scripts:
+        for function in functions:
+            if [i.to_tuple() for i in _dict_decode_instructions(function)] != [i.to_tuple() for i in function['instructions']]:
+                raise Exception('dict decoder differs in function at %i' % function['start'])
+
+    times = {}
+    for name, func in (('dict', dict_decode), ('decode', decode), ('parse', parse)):
+        elapsed = times[name] = best_time(func)
+        print('%-8s %10.2f ms %8.2f M instructions/s' % (name, elapsed * 1000, instructions / elapsed / 1e6 if elapsed else 0))
+    if times['decode']:
+        print('decode speedup over dict: %.2fx' % (times['dict'] / times['decode']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disassembles JerryScript snapshot or all scripts of .wapp file")
+    parser.add_argument(
+        "-f", "--format",
+        default="text",
+        choices=['text', 'json', 'binary', 'xref', 'profile', 'profile-json'],
+        help="Output format, binary is a cache loadable by load_binary(), xref is call graph and string usage, "
+            "profile is size and hot-spot statistics of all scripts, default: text")
+    parser.add_argument(
+        "-n", "--top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="Number of rows of profile tables, default: 20")
+    parser.add_argument(
+        "-o", "--output",
+        metavar="OUTPUT_FILE",
+        help="Output file, or output directory with --batch, default: stdout")
+    parser.add_argument(
+        "-b", "--batch",
+        action="store_true",
+        help="Disassemble all scripts of .wapp files, directories and glob patterns in parallel into OUTPUT directory")
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Number of worker processes with --batch, default: number of CPUs")
+    parser.add_argument(
+        "--cache",
+        default=os.environ.get("WAPP_DISASSEMBLE_CACHE"),
+        metavar="CACHE_DIR",
+        help="Reuse batch results of unchanged scripts stored in CACHE_DIR, default: $WAPP_DISASSEMBLE_CACHE")
+    parser.add_argument(
+        "--cache-size",
+        type=lambda s: int(s) * 1024 * 1024,
+        default=ContentCache.DEFAULT_SIZE,
+        metavar="MB",
+        help="Maximum size of the cache, least recently used results are evicted, default: %i" % (ContentCache.DEFAULT_SIZE >> 20))
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="REPEAT",
+        help="Measure best time of instruction decoding, compared to dict based opcode lookups, and of whole parsing of the input out of REPEAT runs instead of disassembling")
+    parser.add_argument(
+        'input_file',
+        nargs='+',
+        help="JerryScript snapshot or .wapp file, with --batch any number of .wapp files, directories or glob patterns")
+    args = parser.parse_args()
+
+    if args.batch:
+        if not args.output:
+            parser.error("--batch requires -o OUTPUT directory")
+        if args.format not in OUTPUT_EXTENSIONS:
+            parser.error("%s format is not supported with --batch" % args.format)
+        batch(args)
+        return
+
+    if len(args.input_file) != 1:
+        parser.error("only one input file is allowed without --batch")
+    args.input_file = args.input_file[0]
+
+    with open(args.input_file, 'rb') as f:
+        signature = f.read(4)
+
+    try:
+        if signature == b'JRRY':
+            disassemblers = [(None, Disassembler(args.input_file))]
+        else:
+            disassemblers = [(name, Disassembler(buffer=script)) for name, script in wapp_scripts(args.input_file)]
+        scripts = [(name, disassembler.parse()) for name, disassembler in disassemblers]
+    except WappFileError as e:
+        print('Error: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.benchmark:
+        benchmark([(disassembler, functions) for (_name, disassembler), (_name2, functions) in zip(disassemblers, scripts)], args.benchmark)
+        return
+
+    if args.format == 'binary':
+        output = b''.join(struct.pack('<I', len(dump)) + dump for dump in (dump_binary(functions) for _name, functions in scripts))
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(output)
+        else:
+            sys.stdout.buffer.write(output)
+        return
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            if signature == b'JRRY':
+                json.dump(render_json(scripts[0][1]), out, indent=1)
+            else:
+                json.dump({name: render_json(functions) for name, functions in scripts}, out, indent=1)
+            out.write('\n')
+        elif args.format == 'profile':
+            render_profile(profile([(name, d, functions) for (name, functions), (_name, d) in zip(scripts, disassemblers)]), out, args.top)
+        elif args.format == 'profile-json':
+            json.dump(profile([(name, d, functions) for (name, functions), (_name, d) in zip(scripts, disassemblers)]), out, indent=1)
+            out.write('\n')
+        elif args.format == 'xref':
+            for (name, functions), (_name, disassembler) in zip(scripts, disassemblers):
+                if name is not None:
+                    out.write('// script %s\n' % name)
+                render_xref(functions, disassembler.index, out)
+        else:
+            for name, functions in scripts:
+                if name is not None:
+                    out.write('// script %s\n' % name)
+                render_text(functions, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 
 if __name__ == '__main__':
-    disassembler = Disassembler(sys.argv[1])
-    disassembler.start()
+    main()
@@ -42,7 +42,7 @@ opcodes = {
     0x28: {'name': 'CBC_PUSH_LITERAL', 'literal_args': 1, 'byte_args': 0, 'branch_args': 0},
     0x29: {'name': 'CBC_PUSH_TWO_LITERALS', 'literal_args': 2, 'byte_args': 0, 'branch_args': 0},
     0x2A: {'name': 'CBC_PUSH_THIS_LITERAL', 'literal_args': 1, 'byte_args': 0, 'branch_args': 0},
-    0x2B: {'name': 'CBC_PUSH_THREE_LITERALS', 'literal_args': 1, 'byte_args': 0, 'branch_args': 0},
+    0x2B: {'name': 'CBC_PUSH_THREE_LITERALS', 'literal_args': 3, 'byte_args': 0, 'branch_args': 0},
     0x2C: {'name': 'CBC_PUSH_UNDEFINED', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0},
     0x2D: {'name': 'CBC_PUSH_TRUE', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0},
     0x2E: {'name': 'CBC_PUSH_FALSE', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0},
@@ -288,3 +288,17 @@ opcodes_ext = {
     0x43: {'name': 'CBC_EXT_CONSTRUCTOR_RETURN', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0},
     0x44: {'name': 'CBC_EXT_ERROR', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0},
 }
+
+# Precompiled, immutable dispatch table indexed by opcode (0x000-0x0FF) or 0x100 + extended opcode
+# (0x100-0x1FF). Unknown extended opcodes fall back to CBC_EXT_OPCODE.
+EXT_PLANE = 0x100
+UNKNOWN_OPCODE = {'name': 'UNKNOWN', 'literal_args': 0, 'byte_args': 0, 'branch_args': 0}
+
+_plane = [opcodes.get(i, UNKNOWN_OPCODE) for i in range(0x100)] + [opcodes_ext.get(i, opcodes[0x00]) for i in range(0x100)]
+
+# (name, end of literal args, end of byte args, end of branch args) relative to the opcode
+DISPATCH = tuple(
+    (o['name'], 1 + o['literal_args'], 1 + o['literal_args'] + o['byte_args'], 1 + o['literal_args'] + o['byte_args'] + o['branch_args'])
+    for o in _plane)
+
+del _plane
@@ -1,8 +1,13 @@
 
 import argparse
+import collections
+import glob
+import hashlib
+import itertools
 import json
 import os
 import re
+import tempfile
 from jsonschema import validate, ValidationError
 from wapp_tools.appmeta_schema import appmeta_schema
 from math import isqrt
@@ -59,6 +64,22 @@ class ResizeType(object):
         return m.groups()
 
 
+class IntRangeType(object):
+
+    def __init__(self,minValue,maxValue):
+        self.minValue = minValue
+        self.maxValue = maxValue
+
+    def __call__(self,s):
+        try:
+            value = int(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid value")
+        if value < self.minValue or value > self.maxValue:
+            raise argparse.ArgumentTypeError(f"must be between {self.minValue} and {self.maxValue}")
+        return value
+
+
 class AppMetaType(object):
 
     def __init__(self):
@@ -108,6 +129,148 @@ class DirOrFileType(object):
 
         return files
 
+# expands files, directories (recursively) and glob patterns into sorted (path, relative path) pairs,
+# relative path is taken against the directory or the non-wildcard prefix of the pattern
+def expandPaths(paths, extensions = None):
+
+    files = {}
+
+    for p in paths:
+
+        if os.path.isdir(p):
+            for root, _dirs, fileNames in os.walk(p):
+                for fn in fileNames:
+                    if extensions is None or os.path.splitext(fn)[1].lower() in extensions:
+                        path = os.path.join(root,fn)
+                        files[path] = os.path.relpath(path,p)
+
+        elif glob.has_magic(p):
+            parts = p.split(os.sep)
+            base = os.sep.join(itertools.takewhile(lambda part: not glob.has_magic(part), parts))
+            for path in glob.glob(p, recursive=True):
+                if os.path.isfile(path):
+                    files[path] = os.path.relpath(path,base or os.curdir)
+
+        else:
+            files[p] = os.path.basename(p)
+
+    return sorted(files.items())
+
+# Content addressed cache of derived files (encoded images, disassembly, ...). Entries are keyed by the hash
+# of the source and the parameters of the conversion, the least recently used entries are evicted above maxSize.
+class ContentCache:
+
+    DEFAULT_SIZE = 256 * 1024 * 1024
+    _PREFIX = re.compile('[0-9a-f]{2}')
+    _KEY = re.compile('[0-9a-f]{64}')
+
+    def __init__(self, path, maxSize = DEFAULT_SIZE):
+
+        self.path = path
+        self.maxSize = maxSize
+
+    @staticmethod
+    def key(source, **params):
+
+        h = hashlib.sha256(source)
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+
+        path = self._entryPath(key)
+
+        try:
+            with open(path,'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)      # mtime is used as the last access time
+        return content
+
+    def put(self, key, content):
+
+        path = self._entryPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # atomic replace, the cache can be shared by concurrent processes
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                f.write(content)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+
+    def entries(self):
+
+        ret = []
+
+        if not os.path.isdir(self.path):
+            return ret
+
+        # only files named like the keys are entries, the cache dir may be pointed to a directory with other files
+        for d in os.scandir(self.path):
+            if not d.is_dir() or not self._PREFIX.fullmatch(d.name):
+                continue
+            for e in os.scandir(d.path):
+                if e.is_file() and self._KEY.fullmatch(e.name) and e.name.startswith(d.name):
+                    st = e.stat()
+                    ret.append((st.st_mtime, st.st_size, e.path))
+
+        return ret
+
+    def info(self):
+
+        entries = self.entries()
+        return {
+            "path": self.path,
+            "entries": len(entries),
+            "size": sum(e[1] for e in entries),
+            "max_size": self.maxSize,
+        }
+
+    # removes the least recently used entries until the cache fits in maxSize, returns (entries, bytes) removed
+    def prune(self, maxSize = None):
+
+        if maxSize is None:
+            maxSize = self.maxSize
+        if maxSize is None:
+            return (0, 0)
+
+        entries = sorted(self.entries(), reverse=True)
+        total = sum(e[1] for e in entries)
+        removed = (0, 0)
+
+        while entries and total > maxSize:
+            (_mtime, size, path) = entries.pop()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed = (removed[0] + 1, removed[1] + size)
+
+        return removed
+
+# like executor.map, but keeps at most window tasks in flight so results are not piling up in memory
+def prefetchMap(executor, func, items, window):
+
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(executor.submit(func,item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
 def _deepIter(values):
     if not (isinstance(values,list) or isinstance(values,tuple)):
         yield values
@@ -1,14 +1,123 @@
 import argparse
+import csv
+import hashlib
 import os
+import sys
 import json
+import mmap
+from io import StringIO
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from wapp_tools import utils
-from wapp_tools.wapp_file import WappFile, DIRECTORY
+from wapp_tools.wapp_file import WappFile, WappFileWriter, DIRECTORY, VERIFY
+from wapp_tools.disassemble import Disassembler
+
+# previous is the manifest record of the file from the last incremental build,
+# content is None when the file is unchanged and its entry can be copied from the previous package
+def _loadFile(input):
+
+    (dir,fn,previous) = input
+    warning = None
+
+    st = os.stat(fn)
+    record = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+    if previous and all(previous.get(k) == v for k,v in record.items()):
+        return (dir,fn,None,previous.get("warning"),previous)
+
+    with open(fn,"rb") as f:
+        raw = f.read()
+
+    record["sha256"] = hashlib.sha256(raw).hexdigest()
+    if previous and previous.get("sha256") == record["sha256"]:
+        return (dir,fn,None,previous.get("warning"),dict(previous,**record))
+
+    if WappFileWriter.isTextDir(dir):
+        content = json.dumps(json.loads(raw.decode("utf-8")))
+    else:
+        content = raw
+
+    if dir == DIRECTORY.IMAGE:
+        if not utils.FileChecker.detectImage(content).isImage():
+            warning = f"WARNING: file {fn} is not an image"
+    elif dir == DIRECTORY.SCRIPT:
+        if not utils.FileChecker.detectJerry(content).isJerry():
+            warning = f"WARNING: file {fn} is not a jerry script"
+
+    record["warning"] = warning
+    return (dir,fn,content,warning,record)
+
+MANIFEST_VERSION = 1
+
+# returns (manifest records, memory map of the previous package), nothing is reused if they don't match
+def _loadManifest(output):
+
+    previousWapp = None
+    try:
+        with open(output + ".manifest.json","r",encoding="utf-8") as f:
+            manifest = json.load(f)
+        with open(output,"rb") as f:
+            previousWapp = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if manifest["version"] == MANIFEST_VERSION and manifest["wapp_size"] == len(previousWapp) and \
+                previousWapp[-4:] == manifest["crc32"].to_bytes(4,'little'):
+            return (manifest["entries"],previousWapp)
+
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    if previousWapp is not None:
+        previousWapp.close()
+    return ({},None)
+
+# layout fields holding an image file name
+IMAGE_REFERENCE_KEYS = ('image_name', 'header_icon', 'icon')
+
+def _rewriteImageReferences(layout, aliases):
+
+    def rewrite(node):
+        if isinstance(node,dict):
+            return { k: aliases.get(v,v) if k in IMAGE_REFERENCE_KEYS and isinstance(v,str) else rewrite(v) for k,v in node.items() }
+        if isinstance(node,list):
+            return [ rewrite(v) for v in node ]
+        return node
+
+    return json.dumps(rewrite(json.loads(layout)))
+
+# string literals of a jerry snapshot, images named by them are referenced by scripts and can't be dropped.
+# Returns None if the snapshot can't be parsed.
+def _scriptStrings(content):
+
+    try:
+        disassembler = Disassembler(buffer=content)
+        disassembler.parse()
+        return set(disassembler.index.string_usage())
+    except Exception:
+        return None
 
 def create_cmd(args):
 
+    output = None
+    tmpPath = None
+    previousWapp = None
+
     try:
 
-        w = WappFile(
+        previous = {}
+        if args.incremental:
+            if args.output == '-':
+                raise Exception("incremental build needs an output file")
+            (previous,previousWapp) = _loadManifest(args.output)
+
+        # the package is written to a temporary file which replaces the output only when it's complete
+        if args.output == '-':
+            output = sys.stdout.buffer
+        else:
+            output = open(f"{args.output}.{os.getpid()}.tmp","xb")
+            tmpPath = output.name
+
+        # files are streamed to the output, so they have to be added in DIRECTORY order
+        w = WappFileWriter(
+            output,
             appType = args.app_meta["type"],
             appVersion = args.app_meta["version"],
             displayName = args.app_meta["display_name"])
@@ -22,56 +131,134 @@ def create_cmd(args):
 
         dirs = [
             ('script',DIRECTORY.SCRIPT),
-            ('layout',DIRECTORY.LAYOUT),
             ('image',DIRECTORY.IMAGE),
+            ('layout',DIRECTORY.LAYOUT),
             ('config',DIRECTORY.CONFIG) ]
 
-        for d in dirs:
-
-            files = getattr(args,d[0])
-            if files is None:
-                continue
-
-            if args.verbose: print(f"\n{d[1].name}:")
+        # manifest key is directory and absolute path of the input file
+        keys = [ (d[1],fn,f"{d[1].name}:{os.path.abspath(fn)}") for d in dirs for fn in (getattr(args,d[0]) or []) ]
+        inputs = [ (dir,fn,previous.get(key)) for (dir,fn,key) in keys ]
+        manifest = {}
+        reused = 0
+
+        # content hash => (dir, name) of the first file with this content
+        # duplicated images are dropped and layouts refer to the first copy (images are added before layouts),
+        # unless scripts use the image name (scripts are added before images)
+        seen = {}
+        aliases = {}
+        duplicates = []
+        scriptStrings = set()
+        unparsedScripts = []
+
+        def namedByScript(bn):
+            name = bn.encode('utf-8')
+            return name in scriptStrings or any(name in script for script in unparsedScripts)
+
+        # files are read and validated in parallel, but added in the original order
+        lastDir = None
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for (dir,fn,content,warning,record),(_dir,_fn,key) in zip(utils.prefetchMap(executor,_loadFile,inputs,2*args.jobs),keys):
+
+                # image references in layouts depend on the other files
+                if content is None and dir == DIRECTORY.LAYOUT and (record.get("rewritten") or (args.dedup and aliases)):
+                    (dir,fn,content,warning,record) = _loadFile((dir,fn,None))
+
+                if args.verbose:
+                    if dir != lastDir: print(f"\n{dir.name}:")
+                    if content is None: pass
+                    elif WappFileWriter.isTextDir(dir): print("  CHECKING AND MINIFYING JSON")
+                    elif dir == DIRECTORY.IMAGE: print("  CHECKING IMAGE")
+                    elif dir == DIRECTORY.SCRIPT: print("  CHECKING JERRY SCRIPT")
+                lastDir = dir
+
+                if warning: print(warning)
+
+                bn = os.path.basename(fn)
+
+                if content is not None:
+                    if args.dedup and dir == DIRECTORY.LAYOUT and aliases:
+                        rewritten = _rewriteImageReferences(content,aliases)
+                        record["rewritten"] = rewritten != content
+                        content = rewritten
+
+                    buf = content.encode('utf-8') if isinstance(content,str) else content
+                    record["content_sha256"] = hashlib.sha256(buf).hexdigest()
+                    record["content_size"] = len(buf)
+
+                if args.dedup and dir == DIRECTORY.SCRIPT:
+                    if content is None:
+                        with open(fn,"rb") as f:
+                            script = f.read()
+                    else:
+                        script = content
+                    strings = _scriptStrings(script)
+                    if strings is None:
+                        # names are searched in the raw content of scripts which can't be disassembled
+                        unparsedScripts.append(script)
+                    else:
+                        scriptStrings.update(strings)
+
+                if args.dedup:
+                    first = seen.setdefault(record["content_sha256"],(dir,bn))
+
+                    if first != (dir,bn):
+                        named = dir == DIRECTORY.IMAGE and namedByScript(bn)
+                        removed = dir == DIRECTORY.IMAGE and first[0] == DIRECTORY.IMAGE and not named
+                        duplicates.append((dir,bn,first,record["content_size"],removed,named))
+                        if removed:
+                            aliases[bn] = first[1]
+                            if args.verbose: print(f"  SKIP {bn}, same as {first[1]}")
+                            continue
+
+                if content is None:
+                    if args.verbose: print(f"  REUSE {bn}")
+                    entry = previousWapp[record["offset"]:record["offset"]+record["length"]]
+                    (offset,length,crc) = w.addPackedEntry(dir,entry,record["crc32c"])
+                    reused += 1
+                else:
+                    if args.verbose: print(f"  ADD {bn}")
+                    (offset,length,crc) = w.addFile(dir,bn,content)
 
-            wappDir = w.getDirectory(d[1])
-            openParams = {"mode": "r", "encoding": "utf-8"} if wappDir.isTextDir() else {"mode": "rb"}
+                manifest[key] = dict(record,offset=offset,length=length,crc32c=crc)
 
-            for fn in files:
+        if args.verbose: print("\nWRITING WAPP FILE")
 
-                with open(fn,**openParams) as f:
+        w.close()
 
-                    if wappDir.isTextDir():
-                        if args.verbose: print("  CHECKING AND MINIFYING JSON")
-                        content = json.load(f)
-                        content = json.dumps(content)
-                    else:
-                        content = f.read()
+        if previousWapp is not None:
+            previousWapp.close()
 
-                    if d[1] == DIRECTORY.IMAGE:
-                        if args.verbose: print("  CHECKING IMAGE")
-                        if not utils.FileChecker.detectImage(content).isImage():
-                            print("WARNING: file {fn} is not an image")
-                    elif d[1] == DIRECTORY.SCRIPT:
-                        if args.verbose: print("  CHECKING JERRY SCRIPT")
-                        if not utils.FileChecker.detectJerry(content).isJerry():
-                            print("WARNING: file {fn} is not a jerry script")
+        if tmpPath is not None:
+            output.close()
+            os.replace(tmpPath,args.output)
+            tmpPath = None
 
-                    bn = os.path.basename(fn)
+        if args.incremental:
+            with open(args.output + ".manifest.json","w",encoding="utf-8") as f:
+                json.dump({
+                    "version": MANIFEST_VERSION,
+                    "wapp_size": os.path.getsize(args.output),
+                    "crc32": w.crc32,
+                    "entries": manifest }, f, indent=1)
+            print(f"Reused {reused} of {len(keys)} files")
 
-                    if args.verbose: print(f"  ADD {bn}")
-                    wappDir.addFile(bn,content)
+        if duplicates:
+            print("\nDuplicated content:", file=sys.stderr)
+            for (dir,bn,first,size,removed,named) in duplicates:
+                status = ', removed' if removed else ', not removed, named in a script' if named else ''
+                print(f"  {dir.name}/{bn} = {first[0].name}/{first[1]}, {size} bytes{status}", file=sys.stderr)
+            print(f"Removed {sum(d[4] for d in duplicates)} files, {sum(d[3] for d in duplicates if d[4])} bytes", file=sys.stderr)
 
         if args.verbose:
-            meta = w.getMeta()
-            print(f"\nFile content size: {meta['content_size']}")
-            print(f"File content crc32: {hex(meta['crc32'])}")
-
-            print("\nWRITING WAPP FILE")
-
-        w.saveToFile(args.output)
+            print(f"\nFile content size: {w.contentSize}")
+            print(f"File content crc32: {hex(w.crc32)}")
 
     except Exception as e:
+        if previousWapp is not None:
+            previousWapp.close()
+        if tmpPath is not None:
+            output.close()
+            os.remove(tmpPath)
         print(f"Error: {str(e)}")
         exit(1)
 
@@ -80,7 +267,7 @@ def extract_cmd(args):
 
     try:
 
-        w = WappFile(fh = args.input_file)
+        w = WappFile(fh = args.input_file, readOnly = True)
 
         try:
             if args.verbose: print(f"       {'DIR'} {args.output}")
@@ -139,12 +326,80 @@ def extract_cmd(args):
 def info_cmd(args):
 
     try:
-        w = WappFile(fh = args.input_file)
+        w = WappFile(fh = args.input_file, readOnly = True, verify = args.verify)
         print(w)
+        print(f"Validation: {w.validation}")
     except Exception as e:
         print(f"Error: {str(e)}")
         exit(1)
 
+def _inspectFile(job):
+
+    (path,verify) = job
+    record = {"file": path}
+
+    log = StringIO()    # warnings are taken from validation results
+    try:
+        with open(path,"rb") as f, redirect_stdout(log):
+            w = WappFile(fh = f, readOnly = True, verify = verify)
+
+        record["file_size"] = os.path.getsize(path)
+        record.update(w.getMeta())
+        record["crc32"] = f"{record['crc32']:08x}"
+        record["crc_valid"] = w.validation.isValid()
+        if w.validation.warnings:
+            record["warnings"] = w.validation.warnings
+
+        record["directories"] = {}
+        for d in DIRECTORY:
+            dir = w.getDirectory(d)
+            record["directories"][d.name] = {
+                "entries": len(dir),
+                "size": len(w.directories[d]),
+                "files": [ {"name": e.file_name, "size": e.file_size} for e in dir._iterEntries() ]
+            }
+
+    except Exception as e:
+        record["error"] = str(e)
+
+    return record
+
+_INSPECT_CSV_FIELDS = ["file","file_size","file_version","content_size","app_type","app_version","crc32","crc_valid","display_name"]
+
+def inspect_cmd(args):
+
+    files = [ path for path,_rel in utils.expandPaths(args.input,['.wapp']) ]
+    # with OFF mode only the header and the directory tables are read
+    jobs = [ (path,VERIFY.OFF if args.no_verify else VERIFY.EAGER) for path in files ]
+
+    failed = 0
+    out = args.output
+
+    if args.format == 'csv':
+        csvWriter = csv.writer(out)
+        csvWriter.writerow(_INSPECT_CSV_FIELDS + [ f"{d.name.lower()}_{c}" for d in DIRECTORY for c in ("entries","size") ] + ["error"])
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for record in executor.map(_inspectFile,jobs,chunksize=16):
+
+            if "error" in record:
+                failed += 1
+
+            if args.format == 'json':
+                out.write(json.dumps(record) + "\n")
+            else:
+                row = [ record.get(f,"") for f in _INSPECT_CSV_FIELDS ]
+                row[-1] = record.get("display_name",{}).get("display_name","")
+                for d in DIRECTORY:
+                    dirRecord = record.get("directories",{}).get(d.name,{})
+                    row += [ dirRecord.get("entries",""), dirRecord.get("size","") ]
+                row.append(record.get("error",""))
+                csvWriter.writerow(row)
+
+    if failed:
+        print(f"Error: {failed} of {len(jobs)} files could not be parsed",file=sys.stderr)
+        exit(1)
+
 def main():
 
     optParser = argparse.ArgumentParser(description="Create/extract Fossil Hybrid application")
@@ -201,10 +456,25 @@ def main():
     create_parser.add_argument(
         "-o","--output",
         required=True,
-        type=argparse.FileType('wb'),
         metavar="OUTPUT_FILE",
-        help="Output file (.wapp)"
+        help="Output file (.wapp), - for stdout"
         )
+    create_parser.add_argument(
+        "-j","--jobs",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Number of threads reading and validating input files, default: 8")
+    create_parser.add_argument(
+        "-I","--incremental",
+        action='store_true',
+        help="Reuse entries of unchanged input files from the previous OUTPUT_FILE, "
+            "input files are recorded in OUTPUT_FILE.manifest.json")
+    create_parser.add_argument(
+        "-d","--dedup",
+        action='store_true',
+        help="Report files with identical content, drop duplicated images and point layouts to the remaining copy. "
+            "Images whose names are string literals of a script are kept.")
     create_parser.add_argument(
         "-v","--verbose",
         action='store_true',
@@ -234,11 +504,47 @@ def main():
         aliases=['i'],
         help='Prints information about .wapp file')
     info_parser.set_defaults(cmd_func=info_cmd)
+    info_parser.add_argument(
+        "-V","--verify",
+        default="eager",
+        choices=[v.value for v in VERIFY],
+        help="CRC verification: eager (while parsing), lazy or off, default: eager")
     info_parser.add_argument(
         'input_file',
         type=argparse.FileType('rb'),
         help="Input .wapp file")
 
+    inspect_parser = subparsers.add_parser(
+        'inspect',
+        help='Prints machine-readable information about many .wapp files')
+    inspect_parser.set_defaults(cmd_func=inspect_cmd)
+    inspect_parser.add_argument(
+        "-f","--format",
+        default="json",
+        choices=['json','csv'],
+        help="Output format, json is one object per line with a list of files in every directory, default: json")
+    inspect_parser.add_argument(
+        "-o","--output",
+        default=sys.stdout,
+        type=argparse.FileType('w', encoding='utf-8'),
+        metavar="OUTPUT_FILE",
+        help="Output file, default: stdout")
+    inspect_parser.add_argument(
+        "-n","--no-verify",
+        action='store_true',
+        help="Don't verify CRC, reads only the header and the directories")
+    inspect_parser.add_argument(
+        "-j","--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Number of worker processes, default: number of CPUs")
+    inspect_parser.add_argument(
+        'input',
+        nargs='+',
+        metavar="DIR_FILE_OR_GLOB",
+        help="Input .wapp files, dirs (processed recursively) or glob patterns")
+
     args = optParser.parse_args()
     args.cmd_func(args)
 
@@ -1,5 +1,8 @@
 
-from enum import IntEnum
+import mmap
+import shutil
+import tempfile
+from enum import Enum, IntEnum
 from struct import unpack_from, pack_into, pack
 from crc32c import crc32c
 
@@ -35,6 +38,98 @@ class DIRECTORY(IntEnum):
 
 _TEXT_DIRS = [DIRECTORY.LAYOUT, DIRECTORY.DISPLAY_NAME, DIRECTORY.CONFIG]
 
+# CRC32C combination (same as zlib crc32_combine with the Castagnoli polynomial),
+# allows to get CRC of A+B from CRC of A, CRC of B and length of B
+_CRC32C_POLY = 0x82F63B78
+
+def _crc32cMultModP(a, b):
+
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ _CRC32C_POLY if b & 1 else b >> 1
+
+    return p
+
+_CRC32C_X2N = [1 << 30]     # x^(2^n) mod p
+for _n in range(31):
+    _CRC32C_X2N.append(_crc32cMultModP(_CRC32C_X2N[-1],_CRC32C_X2N[-1]))
+
+def _crc32cCombine(crc1, crc2, len2):
+
+    p = 1 << 31     # x^(8*len2) mod p
+    k = 3
+    while len2:
+        if len2 & 1:
+            p = _crc32cMultModP(_CRC32C_X2N[k & 31], p)
+        len2 >>= 1
+        k += 1
+
+    return _crc32cMultModP(p, crc1) ^ crc2
+
+def _packEntry(fileName,content,textDir):
+
+    fileNameBin = bytearray(fileName.encode('utf-8'))
+    if len(fileNameBin) > 0xFE:     # 0xff - null terminator
+        print("WARNING: file name too long, trimming to 254 bytes: {bn}")
+        cutPoint = 0xFE
+        if fileNameBin[cutPoint] & 0xc0 == 0x80:    # mid of utf-8 seq
+            while fileNameBin[cutPoint] & 0xc0 == 0x80:
+                cutPoint -= 1
+        fileNameBin = fileNameBin[:cutPoint]
+    fileNameBin.append(0)   # null terminator
+
+    fileBuf = bytearray()
+    fileBuf.extend(pack('<B',len(fileNameBin)))
+    fileBuf.extend(fileNameBin)
+
+    if isinstance(content,str):
+        content = content.encode('utf-8')
+
+    contentSize = len(content)
+    if textDir:
+        contentSize += 1
+
+    fileBuf.extend(pack('<H',contentSize))
+    fileBuf.extend(content)
+
+    if textDir:
+        fileBuf.extend(b'\x00')
+
+    return fileBuf
+
+def _newHeader(appType,appVersion):
+
+    header = bytearray(_OFFSET.HEADER_SIZE)
+
+    pack_into('<H',header,_OFFSET.MAGIC,0x15FE)
+    pack_into('<H',header,_OFFSET.FILE_VERSION,3)
+    pack_into('B',header,_OFFSET.APP_TYPE,appType)
+
+    ver = tuple(int(i) & 0xFF for i in appVersion.split('.'))
+    pack_into('BBB',header,_OFFSET.APP_VERSION,*ver)
+
+    return header
+
+# dirSizes are sizes of directories in DIRECTORY order
+def _packOffsets(header,dirSizes):
+
+    lastOffset = 0
+    lastSize = len(header)
+    for id,size in zip(DIRECTORY,dirSizes):
+        pack_into('<I',header,id,lastOffset+lastSize)
+        lastOffset += lastSize
+        lastSize = size
+
+    contentSize = lastOffset + lastSize - _OFFSET.CONTENT
+    pack_into("<I",header,_OFFSET.CONTENT_SIZE,contentSize)
+
+
 class WappDirEntry:
 
     def __init__(self,file_name,file_size,content):
@@ -53,11 +148,21 @@ class WappDirectory:
         self.wappFile = wappFile
         self.directoryBuf = directoryBuf
         self.textDir = textDir
+        self.index = None
+        self.crc = 0 if len(directoryBuf) == 0 else None    # CRC32C of directoryBuf, None if unknown
 
-    def __iter__(self):
+    # (name, entry offset, content offset, content size) of every file and name => position of
+    # its first occurrence, built on first use and dropped whenever the directory is modified
+    def _getIndex(self):
+
+        if self.index is not None:
+            return self.index
+
+        entries = []
+        names = {}
 
         i = 0
-        dirView = memoryview(self.directoryBuf)     #memoryview also prevents resize of underlying buffer
+        dirView = memoryview(self.directoryBuf)
         while i < len(dirView):
 
             offset = i
@@ -71,18 +176,71 @@ class WappDirectory:
             fileSize = unpack_from('<H',dirView,i)[0]
             i += 2
 
-            content = dirView[i:i+fileSize]
-            if self.textDir:
-                content = str(content[:-1],'utf-8') #skipping null-terminator
+            names.setdefault(fn,len(entries))
+            entries.append((fn,offset,i,fileSize))
 
             i += fileSize
 
-            yield WappDirEntry(fn,fileSize,content)
+        self.index = (entries,names)
+        return self.index
+
+    def _modified(self, crc = None):
+        self.wappFile.dirty = True
+        self.index = None
+        self.crc = crc
+
+    def getCrc(self):
+
+        if self.crc is None:
+            self.crc = crc32c(self.directoryBuf)
+
+        return self.crc
+
+    def _entry(self,dirView,record):
+
+        (fn,_offset,contentOffset,fileSize) = record
+
+        content = dirView[contentOffset:contentOffset+fileSize]
+        if self.textDir:
+            content = str(content[:-1],'utf-8') #skipping null-terminator
+
+        return WappDirEntry(fn,fileSize,content)
+
+    def _record(self,fileName):
+
+        (entries,names) = self._getIndex()
+        return entries[names[fileName]]
+
+    # iterates without triggering lazy CRC verification, used for names and metadata
+    def _iterEntries(self):
+
+        dirView = memoryview(self.directoryBuf)     #memoryview also prevents resize of underlying buffer
+        for record in self._getIndex()[0]:
+            yield self._entry(dirView,record)
+
+    def __iter__(self):
+
+        self.wappFile._contentAccess()
+        yield from self._iterEntries()
+
+    def __len__(self):
+        return len(self._getIndex()[0])
+
+    def __contains__(self,fileName):
+        return fileName in self._getIndex()[1]
+
+    def get(self,fileName,default = None):
+
+        if fileName not in self:
+            return default
+
+        self.wappFile._contentAccess()
+        return self._entry(memoryview(self.directoryBuf),self._record(fileName))
 
     def __str__(self):
 
         ret = ""
-        for e in self:
+        for e in self._iterEntries():
             ret += " "+str(e)+"\n"
 
         return ret
@@ -93,61 +251,105 @@ class WappDirectory:
     def isTextDir(self):
         return self.textDir
 
+    def _checkWritable(self):
+        if self.wappFile.readOnly:
+            raise WappFileError("File is opened in read-only mode.")
+
     def clean(self):
 
         if self.isEmpty():
             return
 
-        self.wappFile.dirty = True
+        self._checkWritable()
+
+        self._modified(0)
         self.directoryBuf.clear()
 
+    def _packEntry(self,fileName,content):
+        return _packEntry(fileName,content,self.textDir)
 
     def addFile(self,fileName,content):
 
-        self.wappFile.dirty = True
+        self._checkWritable()
 
-        fileNameBin = bytearray(fileName.encode('utf-8'))
-        if len(fileNameBin) > 0xFE:     # 0xff - null terminator
-            print("WARNING: file name too long, trimming to 254 bytes: {bn}")
-            cutPoint = 0xFE
-            if fileNameBin[cutPoint] & 0xc0 == 0x80:    # mid of utf-8 seq
-                while fileNameBin[cutPoint] & 0xc0 == 0x80:
-                    cutPoint -= 1
-            fileNameBin = fileNameBin[:cutPoint]
-        fileNameBin.append(0)   # null terminator
+        fileBuf = self._packEntry(fileName,content)
 
-        fileBuf = bytearray()
-        fileBuf.extend(pack('<B',len(fileNameBin)))
-        fileBuf.extend(fileNameBin)
+        # CRC is extended with the new entry only, no need to rehash the whole directory
+        self._modified(None if self.crc is None else crc32c(fileBuf,self.crc))
+        self.directoryBuf.extend(fileBuf)
 
-        if isinstance(content,str):
-            content = content.encode('utf-8')
+    # removes the first file with the given name, raises KeyError if there is none
+    def removeFile(self,fileName):
 
-        contentSize = len(content)
-        if self.textDir:
-            contentSize += 1
+        self._checkWritable()
+        (_fn,offset,contentOffset,fileSize) = self._record(fileName)
 
-        fileBuf.extend(pack('<H',contentSize))
-        fileBuf.extend(content)
+        self._modified()
+        del self.directoryBuf[offset:contentOffset+fileSize]
 
-        if self.textDir:
-            fileBuf.extend(b'\x00')
+    # replaces content of the first file with the given name keeping its position, raises KeyError if there is none
+    def replaceFile(self,fileName,content):
 
-        self.directoryBuf.extend(fileBuf)
+        self._checkWritable()
+        (_fn,offset,contentOffset,fileSize) = self._record(fileName)
+
+        self._modified()
+        self.directoryBuf[offset:contentOffset+fileSize] = self._packEntry(fileName,content)
 
 
 class WappFileError(Exception):
     pass
 
+class VERIFY(Enum):
+    EAGER = 'eager'     # CRC is verified while parsing, failure raises WappFileError
+    LAZY = 'lazy'       # CRC is verified on the first access to the content of files or by verify()
+    OFF = 'off'         # CRC is verified only by explicit verify()
+
+class WappValidation:
+
+    def __init__(self, storedCrc):
+        self.storedCrc = storedCrc
+        self.calculatedCrc = None
+        self.warnings = []
+
+    def isChecked(self):
+        return self.calculatedCrc is not None
+
+    # None if CRC was not checked yet
+    def isValid(self):
+        if not self.isChecked():
+            return None
+        return self.storedCrc == self.calculatedCrc
+
+    def __str__(self):
+        if not self.isChecked():
+            return "CRC not verified"
+        if self.isValid():
+            return "CRC OK"
+        return f"CRC mismatch, stored {hex(self.storedCrc)}, calculated {hex(self.calculatedCrc)}"
+
 class WappFile:
 
 
-    def __init__(self,fh = None, appType = None, appVersion = None, displayName = None):
+    # readOnly memory-maps the file (if possible) and directories become views into the map,
+    # verify is one of VERIFY modes (True is EAGER, False is OFF), with LAZY or OFF only the header
+    # and the directories are touched while parsing
+    def __init__(self,fh = None, appType = None, appVersion = None, displayName = None, readOnly = False, verify = VERIFY.EAGER):
 
         self.dirty = True
+        self.readOnly = readOnly and fh is not None
+        self.dirObjects = {}
+        self.validation = None
+        self.unverifiedBuf = None
+
+        if verify is True:
+            verify = VERIFY.EAGER
+        elif verify is False:
+            verify = VERIFY.OFF
+        self.verifyMode = VERIFY(verify)
 
         if fh is not None:
-            self._parse(fh)
+            self._parse(fh,verify)
         elif appType is not None and appVersion is not None:
             self._createEmpty(appType,appVersion,displayName)
         else:
@@ -155,9 +357,23 @@ class WappFile:
 
         self.dirty = False
 
-    def _parse(self,fh):
+    @staticmethod
+    def _mapFile(fh):
 
-        wappFile = bytearray(fh.read())
+        try:
+            if fh.tell() == 0:
+                return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+        except (AttributeError, OSError, ValueError):     # not a regular file, e.g. pipe or BytesIO
+            pass
+
+        return memoryview(fh.read())
+
+    def _parse(self,fh,verify = VERIFY.EAGER):
+
+        if self.readOnly:
+            wappFile = self._mapFile(fh)
+        else:
+            wappFile = bytearray(fh.read())
 
         magic = unpack_from('<H',wappFile,_OFFSET.MAGIC)[0]
         if magic != 0x15FE:
@@ -168,16 +384,19 @@ class WappFile:
             raise WappFileError("Wrong file, file size check failed.")
 
         self.crc32 = unpack_from('<I',wappFile,len(wappFile)-4)[0]
-        calculatedCRC = crc32c(memoryview(wappFile)[_OFFSET.CONTENT:-4])
+        self.validation = WappValidation(self.crc32)
+        self.unverifiedBuf = wappFile
 
-        if self.crc32 != calculatedCRC:
+        if self.verifyMode == VERIFY.EAGER and not self.verify().isValid():
             raise WappFileError("Wrong file, checksum failed.")
 
         fileVersion = unpack_from('<H',wappFile,_OFFSET.FILE_VERSION)[0]
         if fileVersion != 3:
-            print(f"WARNING: File version is {fileVersion} while version 3 is supported. It may be wrongly parsed.")
+            warning = f"File version is {fileVersion} while version 3 is supported. It may be wrongly parsed."
+            self.validation.warnings.append(warning)
+            print(f"WARNING: {warning}")
 
-        self.header = wappFile[0:_OFFSET.HEADER_SIZE]
+        self.header = bytearray(wappFile[0:_OFFSET.HEADER_SIZE])
         self.directories = {}
 
         offsets = [*unpack_from("<IIIIIIII",self.header,_OFFSET.SCRIPT_DIR),len(wappFile)-4]    # file end as the last offset
@@ -191,28 +410,42 @@ class WappFile:
 
         for i,dir in enumerate(DIRECTORY):
 
-            if offsets[i+1] - offsets[i] == 0:
+            if offsets[i+1] - offsets[i] == 0 and not self.readOnly:
                 self.directories[dir] = bytearray()
             else:
                 self.directories[dir] = wappFile[offsets[i]:offsets[i+1]]
 
-        self._updateMeta()
+        # CRC was just verified, it is recalculated only if header has to be fixed
+        headerBuf = bytes(self.header)
+        self._packHeader()
+        if self.header != headerBuf:
+            self._updateMeta()
+
+
+    # verifies CRC of the parsed file (once), returns WappValidation
+    def verify(self):
+
+        if self.validation is None:       # created, not parsed
+            return None
 
+        if self.unverifiedBuf is not None:
+            self.validation.calculatedCrc = crc32c(memoryview(self.unverifiedBuf)[_OFFSET.CONTENT:-4])
+            self.unverifiedBuf = None
+
+        return self.validation
+
+    def _contentAccess(self):
+
+        if self.verifyMode == VERIFY.LAZY and self.validation is not None and not self.verify().isValid():
+            raise WappFileError("Wrong file, checksum failed.")
 
     def _createEmpty(self,appType,appVersion,displayName):
 
-        self.header = bytearray(_OFFSET.HEADER_SIZE)
+        self.header = _newHeader(appType,appVersion)
         self.directories = {}
         for d in DIRECTORY:
             self.directories[d] = bytearray()
 
-        pack_into('<H',self.header,_OFFSET.MAGIC,0x15FE)
-        pack_into('<H',self.header,_OFFSET.FILE_VERSION,3)
-        pack_into('B',self.header,_OFFSET.APP_TYPE,appType)
-
-        ver = tuple(int(i) & 0xFF for i in appVersion.split('.'))
-        pack_into('BBB',self.header,_OFFSET.APP_VERSION,*ver)
-
         if displayName is not None:
             dir = self.getDirectory(DIRECTORY.DISPLAY_NAME)
 
@@ -222,28 +455,25 @@ class WappFile:
         self._updateMeta()
 
 
+    def _packHeader(self):
+        _packOffsets(self.header,[len(self.directories[id]) for id in DIRECTORY])
+
     def _updateMeta(self):
 
         if not self.dirty:
             return
 
-        fileSize = 0
-
-        lastOffset = 0
-        lastSize = len(self.header)
-        for id in DIRECTORY:
-            pack_into('<I',self.header,id,lastOffset+lastSize)
-            lastOffset += lastSize
-            lastSize = len(self.directories[id])
-
-        contentSize = lastOffset + lastSize - _OFFSET.CONTENT
-        pack_into("<I",self.header,_OFFSET.CONTENT_SIZE,contentSize)
+        self._packHeader()
 
+        # only the header and directories with unknown CRC are hashed, the rest is combined
         crc32 = crc32c(memoryview(self.header)[_OFFSET.CONTENT:])
         for id in DIRECTORY:
-            crc32 = crc32c(self.directories[id],crc32)
+            dir = self.getDirectory(id)
+            if not dir.isEmpty():
+                crc32 = _crc32cCombine(crc32,dir.getCrc(),len(self.directories[id]))
 
         self.crc32 = crc32
+        self.dirty = False
 
 
     def __str__(self):
@@ -283,7 +513,7 @@ class WappFile:
         }
 
         ret["display_name"] = {}
-        for f in self.getDirectory(DIRECTORY.DISPLAY_NAME):
+        for f in self.getDirectory(DIRECTORY.DISPLAY_NAME)._iterEntries():
             ret["display_name"][f.file_name] = f.content
         if not ret["display_name"]:
             del ret["display_name"]
@@ -296,7 +526,11 @@ class WappFile:
         if not dir in self.directories:
             raise KeyError
 
-        return WappDirectory(self,self.directories[dir],dir in _TEXT_DIRS)
+        # directory objects are kept, so their indexes survive between calls
+        if dir not in self.dirObjects:
+            self.dirObjects[dir] = WappDirectory(self,self.directories[dir],dir in _TEXT_DIRS)
+
+        return self.dirObjects[dir]
 
     def saveToFile(self,fh):
 
@@ -308,3 +542,119 @@ class WappFile:
         fh.write(pack('<I',self.crc32))
 
 
+# Writes .wapp file directly to the output while files are added, only the current entry is kept in memory.
+# Files have to be added in DIRECTORY order, header is patched at the end (output is buffered in a temporary
+# file if it's not seekable).
+class WappFileWriter:
+
+    def __init__(self, fh, appType, appVersion, displayName = None):
+
+        self.header = _newHeader(appType,appVersion)
+        self.displayName = displayName or {}
+        self.crc32 = None
+        self.contentSize = None
+
+        try:
+            self.start = fh.tell()
+            fh.seek(self.start)
+            self.out = fh
+            self.tmp = None
+        except (AttributeError, OSError, ValueError):
+            self.out = self.tmp = tempfile.TemporaryFile()
+            self.start = 0
+
+        self.fh = fh
+        self.out.write(bytes(len(self.header)))      # reserved for the header
+
+        self.dirSizes = {}
+        self.dirs = iter(DIRECTORY)
+        self.currentDir = None
+        self.bodyCrc = 0
+        self.bodySize = 0
+
+    @staticmethod
+    def isTextDir(dir):
+        return dir in _TEXT_DIRS
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        elif self.tmp is not None:
+            self.tmp.close()
+
+    # returns (offset in the file, size, crc32c) of the written buffer
+    def _write(self, buf, crc = None):
+
+        if crc is None:
+            crc = crc32c(buf)
+
+        offset = len(self.header) + self.bodySize
+        self.out.write(buf)
+        self.bodyCrc = _crc32cCombine(self.bodyCrc,crc,len(buf))
+        self.bodySize += len(buf)
+        self.dirSizes[self.currentDir] += len(buf)
+
+        return (offset, len(buf), crc)
+
+    def _nextDir(self):
+
+        self.currentDir = next(self.dirs)
+        self.dirSizes[self.currentDir] = 0
+
+        if self.currentDir == DIRECTORY.DISPLAY_NAME:
+            for item in self.displayName.items():
+                self._write(_packEntry(*item,True))
+
+    def _startEntry(self, dir):
+
+        if self.contentSize is not None:
+            raise WappFileError("File is already closed.")
+
+        if dir == DIRECTORY.DISPLAY_NAME:
+            raise WappFileError("Display names have to be passed to the constructor.")
+
+        if self.currentDir is not None and dir < self.currentDir:
+            raise WappFileError(f"Files have to be added in directory order, {dir.name} is after {self.currentDir.name}.")
+
+        while self.currentDir != dir:
+            self._nextDir()
+
+    # returns (offset in the file, size, crc32c) of the packed entry
+    def addFile(self, dir, fileName, content):
+
+        self._startEntry(dir)
+        return self._write(_packEntry(fileName,content,self.isTextDir(dir)))
+
+    # adds an entry packed by a previous addFile, e.g. copied from an older file,
+    # when crc (crc32c of the entry) is known, the entry is not hashed again
+    def addPackedEntry(self, dir, entry, crc = None):
+
+        self._startEntry(dir)
+        return self._write(entry,crc)
+
+    def close(self):
+
+        if self.contentSize is not None:
+            return
+
+        while self.currentDir != DIRECTORY.APP_INFO:
+            self._nextDir()
+
+        _packOffsets(self.header,[self.dirSizes[id] for id in DIRECTORY])
+        self.contentSize = unpack_from("<I",self.header,_OFFSET.CONTENT_SIZE)[0]
+
+        self.crc32 = _crc32cCombine(crc32c(memoryview(self.header)[_OFFSET.CONTENT:]),self.bodyCrc,self.bodySize)
+        self.out.write(pack('<I',self.crc32))
+
+        self.out.seek(self.start)
+        self.out.write(self.header)
+
+        if self.tmp is not None:
+            self.tmp.seek(0)
+            shutil.copyfileobj(self.tmp,self.fh)
+            self.tmp.close()
+        else:
+            self.out.seek(0,2)
@@ -1,255 +1,706 @@
 import argparse
-from PIL import Image
+import functools
+import json
+import os
+import re
+import sys
+import time
+from PIL import Image, ImageMath
 from math import isqrt
-from io import BytesIO
-from wapp_tools.utils import ResizeType,FileChecker
+from io import BytesIO, StringIO
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from wapp_tools.utils import ResizeType,IntRangeType,FileChecker,ContentCache,expandPaths
 
-def _getPixel(image,x,y):
+# RGB weights of the gray level, average is (r+g+b)/3
+LUMA = {
+    'average': None,
+    'rec601': (0.299, 0.587, 0.114),
+    'rec709': (0.2126, 0.7152, 0.0722),
+}
 
+DITHER = ['none', 'ordered', 'floyd-steinberg']
 
-    srcPixel = image.getpixel((x, y))
-    dstPixel = 0
+RESAMPLE = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
 
-    if image.mode == 'L':
+# 4x4 Bayer matrix scaled to thresholds in 0..254
+_BAYER = bytes((v * 2 + 1) * 255 // 32 for v in (0,8,2,10, 12,4,14,6, 3,11,1,9, 15,7,13,5))
 
-        dstPixel = srcPixel >> 6
+# palette of the 4 gray levels of the watch, the index is the 2-bit pixel
+_GRAY_PALETTE = Image.new('P',(1,1))
+_GRAY_PALETTE.putpalette([ 0x55 * c for c in range(4) for _rgb in range(3) ])
 
-    elif image.mode == 'LA':
+def _grayImage(image, bands, luma):
 
-        dstPixel = srcPixel[0] >> 6
-        alpha = ~(srcPixel[1]) & 0xc0
-        dstPixel |= (alpha >> 4)
+    if 'L' in bands:
+        return bands['L']
+    if LUMA[luma] is None:
+        return ImageMath.lambda_eval(lambda b: (b['R'] + b['G'] + b['B']) / 3, **bands).convert('L')
+    return image.convert('RGB').convert('L', matrix=LUMA[luma] + (0,))
 
-    else:   #RGB or RGBA
+@functools.lru_cache(maxsize=16)
+def _bayerImage(width, height):
 
-        dstPixel = int((srcPixel[0] + srcPixel[1] + srcPixel[2]) / 3) >> 6
+    rows = [ (_BAYER[4*(y % 4):4*(y % 4)+4] * (width // 4 + 1))[:width] for y in range(4) ]
+    return Image.frombytes('L', (width,height), b''.join(rows[y % 4] for y in range(height)))
 
-        if image.mode == 'RGBA':
-            alpha = ~(srcPixel[3]) & 0xc0
-            dstPixel |= (alpha >> 4)
+# gray image is quantized to 2-bit levels, by cutting the lowest bits or with dithering
+def _quantize(gray, dither):
 
-    return dstPixel
+    if dither == 'floyd-steinberg':
+        indexes = gray.convert('RGB').quantize(palette=_GRAY_PALETTE, dither=Image.Dither.FLOYDSTEINBERG)
+        return Image.frombytes('L', indexes.size, indexes.tobytes())
+    if dither == 'ordered':
+        return ImageMath.lambda_eval(lambda b: (b['g'] * 3 + b['t']) / 255, g=gray, t=_bayerImage(*gray.size))
+    return ImageMath.lambda_eval(lambda b: b['g'] >> 6, g=gray)
 
-def encodeRLE(input, output, resize, verbose = False):
+# whole image is converted at once to a buffer of 4-bit pixels, one byte per pixel,
+# bits 0-1 hold the gray level and bits 2-3 the inverted alpha
+def _getPixels(image, luma = 'average', dither = 'none'):
 
-    if verbose: print(f"Encoding to RLE, reading input image file")
-    image = Image.open(input)
+    bands = dict(zip(image.getbands(), image.split()))
+    pixels = _quantize(_grayImage(image, bands, luma), dither)
 
-    if verbose: print(f"Image mode: {image.mode}")
-    if image.mode not in ['RGBA','RGB','L','LA']:
-        print('Error: PNG color space has to be RGB/24, RGBA/32b, gray/8 or gray+alpha/16')
-        exit(1)
+    if 'A' in bands:
+        pixels = ImageMath.lambda_eval(lambda b: b['p'] | (((~b['A']) & 0xc0) >> 4), p=pixels, A=bands['A'])
 
-    width = int(resize[0] or image.width)
-    height = int(resize[1] or image.height)
+    return pixels.convert('L').tobytes()
 
-    if verbose: print(f"Image resolution: {image.width}x{image.height}")
-    if verbose: print(f"Target resolution: {width}x{height}")
-    if width > 0xFF or height > 0xFF:
-        print('ERROR: Image is too big. Maximum resolution is 256x256')
-        exit(1)
+_RUN_RE = re.compile(rb'(.)\1*', re.DOTALL)
 
-    if width != image.width or height != image.height:
-        if verbose: print(f"Resizing from {image.width}x{image.height} to {width}x{height}")
-        image = image.resize((width, height),resample=Image.Resampling.NEAREST)
+def _packRLE(pixels):
 
     outputBuf = bytearray()
-    lastPixel = None
-    count = 1
 
-    for y in range(0, height):
-        for x in range(0, width):
+    for run in _RUN_RE.finditer(pixels):
+        pixel = pixels[run.start()]
+        (full, count) = divmod(run.end() - run.start(), 255)
+        outputBuf.extend(bytes([255,pixel]) * full)
+        if count:
+            outputBuf.extend([count,pixel])
 
-            pixel = _getPixel(image,x,y)
+    return outputBuf
 
-            if lastPixel is None:
-                lastPixel = pixel
-            elif lastPixel == pixel and count < 255:
-                count += 1
-            else:
-                outputBuf.extend([count,lastPixel])
-                lastPixel = pixel
-                count = 1
+_DROP_ALPHA = bytes(i & 0x03 for i in range(256))
 
-    outputBuf.extend([count,lastPixel])
+def _packRAW(pixels):
 
-    if verbose: print(f"Saving file")
+    # pixels are stored from the last one, 4 pixels per byte, the first one in the highest bits
+    pixels = pixels[::-1].translate(_DROP_ALPHA)
+    pixels += bytes(-len(pixels) % 4)
 
-    if len(outputBuf)+4 > 0xFFFF:
-        print("ERROR: output file too big (>64kB)")
-        exit(1)
+    # bytes are OR-ed as a single big integer, 2-bit fields never overlap
+    packed = 0
+    for i in range(4):
+        packed |= int.from_bytes(pixels[i::4], 'big') << (6 - 2*i)
 
-    output.write(bytes([width,height]))
-    output.write(outputBuf)
-    output.write(bytes([0xFF,0xFF]))
+    return bytearray(packed.to_bytes(len(pixels) // 4, 'big'))
 
+class WappImageError(ValueError):
+    pass
 
-def encodeRAW(input, output, resize, verbose = False):
+def _noLog(message):
+    pass
 
-    if verbose: print(f"Encoding to RAW, reading input image file")
-    image = Image.open(input)
+# image is a PIL image or an encoded image file (PNG, ...) in bytes
+def _loadImage(image, resize, log):
+
+    if not isinstance(image, Image.Image):
+        try:
+            image = Image.open(BytesIO(image))
+        except OSError:
+            raise WappImageError("Cannot read the image, unsupported file format")
 
-    if verbose: print(f"Image mode: {image.mode}")
+    log(f"Image mode: {image.mode}")
     if image.mode not in ['RGBA','RGB','L','LA']:
-        print('Error: PNG color space has to be RGB/24, RGBA/32b, gray/8 or gray+alpha/16')
-        exit(1)
+        raise WappImageError('PNG color space has to be RGB/24, RGBA/32b, gray/8 or gray+alpha/16')
 
     width = int(resize[0] or image.width)
     height = int(resize[1] or image.height)
 
-    if verbose: print(f"Image resolution: {width}x{height}")
+    log(f"Image resolution: {image.width}x{image.height}")
+    log(f"Target resolution: {width}x{height}")
 
-    if width != height:
-        print('ERROR: image must be square for raw compression')
-        exit(1)
+    return (image, width, height)
+
+def _resizeImage(image, width, height, resample, log):
 
     if width != image.width or height != image.height:
-        if verbose: print(f"Resizing from {image.width}x{image.height} to {width}x{height}")
-        image = image.resize((width, height),resample=Image.Resampling.NEAREST)
+        log(f"Resizing from {image.width}x{image.height} to {width}x{height}")
+        image = image.resize((width, height),resample=RESAMPLE[resample])
 
-    outputBuf = bytearray()
-    shiftCounter = 6
-    shiftReg = 0
+    return image
 
-    for y in reversed(range(0, height)):
-        for x in reversed(range(0, width)):
+def encodeRLEImage(image, resize = (None,None), luma = 'average', dither = 'none', resample = 'nearest', log = _noLog):
 
-            pixel = _getPixel(image,x,y) & 0x03 # drop alpha
+    (image, width, height) = _loadImage(image, resize, log)
 
-            shiftReg |= pixel << shiftCounter
+    if width > 0xFF or height > 0xFF:
+        raise WappImageError('Image is too big. Maximum resolution is 256x256')
 
-            if (shiftCounter == 0):
-                outputBuf.append(shiftReg)
-                shiftReg = 0
-                shiftCounter = 6
-            else:
-                shiftCounter -= 2
+    image = _resizeImage(image, width, height, resample, log)
+    outputBuf = bytes([width,height]) + _packRLE(_getPixels(image,luma,dither)) + bytes([0xFF,0xFF])
+
+    if len(outputBuf) > 0xFFFF:
+        raise WappImageError("output file too big (>64kB)")
+
+    return outputBuf
+
+def encodeRAWImage(image, resize = (None,None), luma = 'average', dither = 'none', resample = 'nearest', log = _noLog):
 
-    if (shiftCounter != 6):
-        outputBuf.append(shiftReg)
+    (image, width, height) = _loadImage(image, resize, log)
+
+    if width != height:
+        raise WappImageError('image must be square for raw compression')
+
+    image = _resizeImage(image, width, height, resample, log)
+    outputBuf = bytes(_packRAW(_getPixels(image,luma,dither)))
 
     if len(outputBuf) > 0xFFFF:
-        print("ERROR: output file too big (>64kB)")
-        exit(1)
+        raise WappImageError("output file too big (>64kB)")
 
-    if verbose: print(f"Saving file")
-    output.write(outputBuf)
+    return outputBuf
+
+# encodes pixels once into both formats and returns the smaller one which fits the limits,
+# returns (format, encoded image, report of both sizes)
+def _encodeAuto(image, resize, luma, dither, resample, log):
+
+    (image, width, height) = _loadImage(image, resize, log)
+    image = _resizeImage(image, width, height, resample, log)
+
+    pixels = _getPixels(image,luma,dither)
+    candidates = []
+
+    if width > 0xFF or height > 0xFF:
+        rleReport = "image too big"
+    else:
+        outputBuf = bytes([width,height]) + _packRLE(pixels) + bytes([0xFF,0xFF])
+        rleReport = f"{len(outputBuf)} bytes"
+        if len(outputBuf) > 0xFFFF:
+            rleReport += " (too big)"
+        else:
+            candidates.append((len(outputBuf),'rle',outputBuf))
 
+    if width != height:
+        rawReport = "image not square"
+    elif pixels.translate(_DROP_ALPHA) != pixels:
+        rawReport = "image has transparent pixels"     # RAW has no alpha
+    else:
+        outputBuf = bytes(_packRAW(pixels))
+        rawReport = f"{len(outputBuf)} bytes"
+        if len(outputBuf) > 0xFFFF:
+            rawReport += " (too big)"
+        else:
+            candidates.append((len(outputBuf),'raw',outputBuf))
+
+    if not candidates:
+        raise WappImageError(f"image can't be encoded, RLE: {rleReport}, RAW: {rawReport}")
+
+    (_size, format, outputBuf) = min(candidates, key=lambda c: c[0])     # RLE on a tie, it's autodetected first
+    return (format, outputBuf, f"RLE: {rleReport}, RAW: {rawReport}, using {format.upper()}")
+
+# encodes PIL image or image file content into Fossil image format (rle, raw or auto - the smaller of them),
+# returns (used format, encoded image), the format isn't reliably detectable from the encoded image
+def encodeImage(image, format = 'rle', resize = (None,None), luma = 'average', dither = 'none', resample = 'nearest', log = _noLog):
+
+    if format == 'rle':
+        return ('rle', encodeRLEImage(image, resize, luma, dither, resample, log))
+    if format == 'raw':
+        return ('raw', encodeRAWImage(image, resize, luma, dither, resample, log))
+    if format == 'auto':
+        (format, outputBuf, report) = _encodeAuto(image, resize, luma, dither, resample, log)
+        log(report)
+        return (format, outputBuf)
+    raise WappImageError(f"Unknown image format {format}")
 
 # scaling 2 bits to 8 bits, 0 => 0, ... , 0b11 => 0xFF
 def bitscale2to8(c):
     return 0x55 * (c & 3)
 
-def decodeRAW(input, output, verbose = False):
+# one input byte expands to 4 RGB pixels, the first one in the highest bits
+_RAW_RGB = [ b''.join(bytes([bitscale2to8(b >> s)]) * 3 for s in (6,4,2,0)) for b in range(256) ]
 
-    size = 0
-    def rawEncoder():
-        nonlocal input,size
-        while b := input.read(1):     # read is buffered so no optimization is needed
-            b = b[0]
-            size += 1
-            for _a in range(4):
-                for _b in range(3):
-                    yield bitscale2to8(b >> 6)
-                b <<= 2
+# one RLE color byte expands to a single RGBA pixel
+_RLE_RGBA = [ bytes([bitscale2to8(b)] * 3 + [bitscale2to8(~(b >> 2))]) for b in range(256) ]
 
-    if verbose: print(f"Decoding RAW image")
+def decodeRAWImage(buffer):
 
-    pixels = bytes(rawEncoder())
+    size = len(buffer)
 
     w = isqrt(size)
     if w*w != size:
-        print("ERROR: Faulty image file - wrong file size")
-        exit(1)
+        raise WappImageError("Faulty image file - wrong file size")
 
     w <<= 1     # 4 pixels per byte, squared
 
-    if verbose: print(f"Image resolution: {w}x{w}")
-    image = Image.frombuffer('RGB', (w, w), pixels)
+    pixels = b''.join(map(_RAW_RGB.__getitem__, buffer))
+    return Image.frombuffer('RGB', (w, w), pixels).transpose(Image.Transpose.ROTATE_180)
 
-    if verbose: print(f"Saving to PNG")
-    image.transpose(Image.Transpose.ROTATE_180).save(output, 'PNG')
+# returns (width, height) of an RLE image, raises WappImageError if the buffer is not a valid RLE image
+def rleSize(buffer):
 
-def decodeRLE(input, output, verbose = False):
+    if len(buffer) < 2 or len(buffer) % 2:
+        raise WappImageError("Faulty image file - wrong file size")
 
-    try:
+    if buffer[-2:] != b'\xff\xff' or len(buffer) < 4:
+        raise WappImageError("Faulty image file, missing 0xFF 0xFF at end")
 
-        if verbose: print(f"Decoding RLE image")
+    return (buffer[0], buffer[1])
 
-        (width,height) = input.read(2)      # can throw ValueError
+# decodes RLE image into a preallocated writable buffer (bytearray, memoryview, ...) of at least width*height*4 bytes,
+# RGBA pixels are written row by row, returns (width, height)
+def decodeRLEInto(buffer, out):
 
-        if verbose: print(f"Image resolution: {width}x{height}")
+    (width,height) = rleSize(buffer)
+    size = width * height * 4
+    out = memoryview(out).cast('B')
 
-        image_pixels = bytearray()
-        rep = None
-        byte = None
+    if len(out) < size:
+        raise WappImageError(f"Output buffer too small, {size} bytes needed")
 
-        while r := input.read(2):   # read is buffered so no optimization is needed
+    pos = 0
+    for rep,byte in zip(buffer[2:-2:2],buffer[3:-2:2]):
+        end = min(pos + 4*rep, size)
+        out[pos:end] = (_RLE_RGBA[byte] * rep)[:end-pos]
+        pos = end
 
-            if rep is not None:
+    if pos < size:
+        raise WappImageError("Faulty image file - not enough pixel data")
 
-                color = bitscale2to8(byte)
-                alpha = bitscale2to8(~(byte >> 2))
-                image_pixels.extend([color, color, color, alpha] * rep)
+    return (width,height)
 
-            (rep, byte) = r     # can throw ValueError
+# yields rows of RLE image as RGBA bytes, only a single row is held in memory,
+# runs spanning several rows are split
+def iterRLERows(buffer):
 
-    except ValueError:
-        print("ERROR: Faulty image file - wrong file size")
-        exit(1)
+    (width,height) = rleSize(buffer)
+    rowSize = width * 4
+    if not rowSize or not height:
+        return
+
+    row = bytearray(rowSize)
+    pos = 0
+    rows = 0
+
+    for rep,byte in zip(buffer[2:-2:2],buffer[3:-2:2]):
+        pixel = _RLE_RGBA[byte]
+        while rep:
+            count = min(rep, (rowSize - pos) >> 2)
+            row[pos:pos + 4*count] = pixel * count
+            pos += 4*count
+            rep -= count
+
+            if pos == rowSize:
+                yield bytes(row)
+                rows += 1
+                if rows == height:
+                    return
+                pos = 0
+
+    raise WappImageError("Faulty image file - not enough pixel data")
+
+def decodeRLEImage(buffer):
+
+    (width,height) = rleSize(buffer)
+    image_pixels = bytearray(width * height * 4)
+    decodeRLEInto(buffer, image_pixels)
+
+    return Image.frombuffer('RGBA', (width, height), image_pixels)
+
+MAX_FILE_SIZE = 0xFFFF   #max size of file inside wapp file
+
+# extensions of encoded images, decoded in batches
+FOSSIL_IMAGE_EXTENSIONS = ['.rle', '.raw', '.img']
+
+def detectFormat(buffer, log = _noLog):
+
+    if len(buffer) > MAX_FILE_SIZE:
+        raise WappImageError("Format autodetection failed, the file is too big.")
+
+    result = FileChecker.detectImage(buffer,quick=False)
 
-    if rep != 0xFF or byte != 0xFF:
-        print('ERROR: Faulty image file, missing 0xFF 0xFF at end')
+    if not result.isImage():
+        raise WappImageError("Format autodetection failed, unknown file format.")
+    elif result.possibleRLE and result.possibleRAW:
+        log("RLE format detected, but it may be RAW. Decoding as RLE.")
+        return 'rle'
+    elif result.possibleRLE:
+        log("RLE format detected.")
+        return 'rle'
+    else:
+        log("RAW format detected.")
+        return 'raw'
+
+# decodes Fossil image (rle, raw or auto - detected) into a PIL image
+def decodeImage(buffer, format = 'auto', log = _noLog):
+
+    if format == 'auto':
+        format = detectFormat(buffer, log)
+
+    if format == 'rle':
+        return decodeRLEImage(buffer)
+    if format == 'raw':
+        return decodeRAWImage(buffer)
+    raise WappImageError(f"Unknown image format {format}")
+
+# command line wrappers, errors are printed and end the process
+
+def _run(func, *args):
+
+    try:
+        return func(*args)
+    except WappImageError as e:
+        print(f"ERROR: {e}")
         exit(1)
 
-    image = Image.frombuffer('RGBA', (width, height), image_pixels)
+def encodeRLE(input, output, resize, verbose = False, luma = 'average', dither = 'none', resample = 'nearest'):
+
+    if verbose: print(f"Encoding to RLE, reading input image file")
+    outputBuf = _run(encodeRLEImage, input.read(), resize, luma, dither, resample, print if verbose else _noLog)
+
+    if verbose: print(f"Saving file")
+    output.write(outputBuf)
+
+def encodeRAW(input, output, resize, verbose = False, luma = 'average', dither = 'none', resample = 'nearest'):
+
+    if verbose: print(f"Encoding to RAW, reading input image file")
+    outputBuf = _run(encodeRAWImage, input.read(), resize, luma, dither, resample, print if verbose else _noLog)
+
+    if verbose: print(f"Saving file")
+    output.write(outputBuf)
+
+# returns the report of both sizes, the caller prints it
+def encodeAuto(input, output, resize, verbose = False, luma = 'average', dither = 'none', resample = 'nearest'):
+
+    if verbose: print(f"Encoding to RLE or RAW, reading input image file")
+    (_format, outputBuf, report) = _run(_encodeAuto, input.read(), resize, luma, dither, resample, print if verbose else _noLog)
+
+    if verbose: print(f"Saving file")
+    output.write(outputBuf)
+    return report
+
+# the report goes to stderr when the image is written to stdout
+def _printReport(report, output):
+    print(report, file=sys.stderr if output is getattr(sys.stdout,'buffer',None) else sys.stdout)
+
+def decodeRAW(input, output, verbose = False):
+
+    if verbose: print(f"Decoding RAW image")
+    image = _run(decodeRAWImage, input.read())
+
+    if verbose: print(f"Image resolution: {image.width}x{image.height}")
     if verbose: print(f"Saving to PNG")
     image.save(output, 'PNG')
 
-def decode(args):
+def decodeRLE(input, output, verbose = False):
 
-    if args.format == 'auto':
+    if verbose: print(f"Decoding RLE image")
+    image = _run(decodeRLEImage, input.read())
 
-        # I don't want to use seek and tell as we can get streams which are not seekable
-        MAX_FILE_SIZE = 0xFFFF   #max size of file inside wapp file
-        buffer = args.input.read(MAX_FILE_SIZE+1)
-        if len(buffer) > MAX_FILE_SIZE:
-            print("ERROR: Format autodetection failed, the file is too big.")
-            exit(1)
+    if verbose: print(f"Image resolution: {image.width}x{image.height}")
+    if verbose: print(f"Saving to PNG")
+    image.save(output, 'PNG')
 
-        result = FileChecker.detectImage(buffer,quick=False)
+def decode(args):
 
-        if not result.isImage():
-            print("ERROR: Format autodetection failed, unknown file format.")
-            exit(1)
-        elif result.possibleRLE and result.possibleRAW:
-            if args.verbose: print("RLE format detected, but it may be RAW. Decoding as RLE.")
-            args.format = 'rle'
-        elif result.possibleRLE:
-            if args.verbose: print("RLE format detected.")
-            args.format = 'rle'
-        else:
-            if args.verbose: print("RAW format detected.")
-            args.format = 'raw'
+    format = args.format
+    input = args.input
 
-        args.input = BytesIO(buffer)
+    if format == 'auto':
+        # I don't want to use seek and tell as we can get streams which are not seekable
+        buffer = input.read(MAX_FILE_SIZE+1)
+        format = _run(detectFormat, buffer, print if args.verbose else _noLog)
+        input = BytesIO(buffer)
 
-    if args.format == 'rle':
+    if format == 'rle':
         decodeFunc = decodeRLE
     else:
         decodeFunc = decodeRAW
 
-    decodeFunc(args.input, args.output, args.verbose)
+    decodeFunc(input, args.output, args.verbose)
+
+# bump when encoders or cache entries change their output, it invalidates cached images
+ENCODER_VERSION = 2
 
 def encode(args):
 
     if args.format == 'rle':
         encodeFunc = encodeRLE
-    else:
+    elif args.format == 'raw':
         encodeFunc = encodeRAW
+    else:
+        encodeFunc = encodeAuto
+
+    if not args.cache:
+        report = encodeFunc(args.input,args.output,args.resize,args.verbose,args.luma,args.dither,args.resample)
+        if report is not None:
+            _printReport(report, args.output)
+        return
+
+    cache = ContentCache(args.cache, args.cache_size)
+    source = args.input.read()
+    key = cache.key(source, format=args.format, resize=args.resize, luma=args.luma, dither=args.dither,
+        resample=args.resample, version=ENCODER_VERSION)
+
+    encoded = cache.get(key)
+    if encoded is not None:
+        if args.verbose: print(f"Cache hit, {len(encoded)} bytes")
+    else:
+        if args.verbose: print(f"Cache miss")
+        buf = BytesIO()
+        report = encodeFunc(BytesIO(source),buf,args.resize,args.verbose,args.luma,args.dither,args.resample)
+        encoded = buf.getvalue()
+        if report is not None:
+            # auto format keeps its report in the first line of the entry, so it's printed on hits too
+            encoded = report.encode('utf-8') + b'\n' + encoded
+        cache.put(key,encoded)
+        cache.prune()
+
+    if args.format == 'auto':
+        (report, _sep, encoded) = encoded.partition(b'\n')
+        _printReport(report.decode('utf-8'), args.output)
+
+    args.output.write(encoded)
 
-    encodeFunc(args.input,args.output,args.resize,args.verbose)
+def cache_info(args):
+
+    info = ContentCache(args.cache, args.cache_size).info()
+    print(f"Cache directory: {info['path']}")
+    print(f"Entries: {info['entries']}")
+    print(f"Size: {info['size']} bytes")
+    print(f"Maximum size: {info['max_size']} bytes")
+
+def cache_prune(args):
+
+    cache = ContentCache(args.cache, args.cache_size)
+    (entries, size) = cache.prune(0 if args.all else None)
+    print(f"Removed {entries} entries, {size} bytes")
+
+
+def _batchJob(job):
+
+    (cmdFunc, src, dst, options) = job
+
+    log = StringIO()
+    tmpPath = f"{dst}.{os.getpid()}.tmp"
+    created = False
+    try:
+        # written to a temporary file first, so a failed job doesn't leave or remove anything at dst
+        os.makedirs(os.path.dirname(dst) or os.curdir, exist_ok=True)
+        with open(src,'rb') as input, open(tmpPath,'xb') as output, redirect_stdout(log):
+            created = True
+            cmdFunc(argparse.Namespace(input=input, output=output, **options))
+        os.replace(tmpPath, dst)
+        return (src, dst, True, log.getvalue())
+
+    except (Exception, SystemExit) as e:
+        if created:
+            os.remove(tmpPath)
+        return (src, dst, False, log.getvalue().strip() or str(e) or type(e).__name__)
+
+def batch(args):
+
+    options = {"format": args.format, "verbose": args.verbose}
+
+    if args.batch_func == encode:
+        options["resize"] = args.resize
+        options["luma"] = args.luma
+        options["dither"] = args.dither
+        options["resample"] = args.resample
+        options["cache"] = args.cache
+        options["cache_size"] = None     # pruned once the whole batch is done
+        files = expandPaths(args.input, ['.png'])
+        ext = ".img" if args.format == 'auto' else f".{args.format}"
+    else:
+        files = expandPaths(args.input, FOSSIL_IMAGE_EXTENSIONS)
+        ext = ".png"
+
+    jobs = []
+    outputs = {}
+    for src,rel in files:
+        dst = os.path.join(args.output, os.path.splitext(rel)[0] + ext)
+
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            print(f"SKIPPED {src}: output is the input file")
+            continue
+
+        key = os.path.normcase(os.path.abspath(dst))
+        if key in outputs:
+            print(f"ERROR: {outputs[key]} and {src} have the same output file {dst}")
+            exit(1)
+        outputs[key] = src
 
+        jobs.append((args.batch_func, src, dst, options))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for (src, dst, ok, log) in executor.map(_batchJob, jobs, chunksize=16):
+
+            if ok:
+                print(f"OK     {src} -> {dst}")
+                if (args.verbose or args.format == 'auto') and log: print("       " + log.strip().replace("\n","\n       "))
+            else:
+                failed += 1
+                print(f"FAILED {src}: {log}")
+
+    print(f"\nFiles: {len(jobs)}, converted: {len(jobs) - failed}, failed: {failed}")
+
+    if options.get("cache"):
+        ContentCache(args.cache, args.cache_size).prune()
+
+    if failed:
+        exit(1)
+
+# shelf packing, first fit decreasing height: images are placed left to right on the first shelf
+# with enough room, a new shelf (or sheet) is started below when none fits. Returns [(width, height, [(item, x, y)])]
+def _packSheets(items, maxWidth, maxHeight, padding):
+
+    sheets = []     # [shelves, placements], shelf is [y, height, used width]
+
+    for item in sorted(items, key=lambda i: (-i[1][1], -i[1][0])):
+        (_name, (width, height)) = item
+        if width > maxWidth or height > maxHeight:
+            raise WappImageError(f"image {item[0]} is bigger than the sheet ({width}x{height})")
+
+        placed = False
+        for (shelves, placements) in sheets:
+            for shelf in shelves:
+                if height <= shelf[1] and shelf[2] + width <= maxWidth:
+                    placements.append((item, shelf[2], shelf[0]))
+                    shelf[2] += width + padding
+                    placed = True
+                    break
+            if not placed:
+                y = shelves[-1][0] + shelves[-1][1] + padding
+                if y + height <= maxHeight:
+                    shelves.append([y, height, width + padding])
+                    placements.append((item, 0, y))
+                    placed = True
+            if placed:
+                break
+
+        if not placed:
+            sheets.append(([[0, height, width + padding]], [(item, 0, 0)]))
+
+    ret = []
+    for (shelves, placements) in sheets:
+        width = max(x + item[1][0] for (item, x, _y) in placements)
+        height = max(y + item[1][1] for (item, _x, y) in placements)
+        ret.append((width, height, placements))
+    return ret
+
+# packs and encodes sheets, sheets over the size limit of an encoded image are split and packed again,
+# returns [(width, height, placements, format, encoded sheet)]
+def _encodeSheets(sprites, items, maxWidth, maxHeight, args):
+
+    ret = []
+
+    for (width, height, placements) in _packSheets(items, maxWidth, maxHeight, args.padding):
+
+        if args.format == 'raw':
+            width = height = max(width, height) + max(width, height) % 2
+
+        # unused area stays transparent, RAW has no alpha so it's black there
+        sheet = Image.new('RGBA', (width, height), (0, 0, 0, 255 if args.format == 'raw' else 0))
+        for ((name, _size), x, y) in placements:
+            sheet.paste(sprites[name], (x, y))
+
+        try:
+            (format, outputBuf) = encodeImage(sheet, args.format, (None,None), args.luma, args.dither, 'nearest', print if args.verbose else _noLog)
+        except WappImageError:
+            if len(placements) == 1:
+                raise
+            placed = [ item for (item, _x, _y) in placements ]
+            ret += _encodeSheets(sprites, placed[:len(placed)//2], maxWidth, maxHeight, args)
+            ret += _encodeSheets(sprites, placed[len(placed)//2:], maxWidth, maxHeight, args)
+            continue
+
+        ret.append((width, height, placements, format, outputBuf))
+
+    return ret
+
+def atlas(args):
+
+    sprites = {}
+    for src, rel in expandPaths(args.input, ['.png']):
+        name = os.path.splitext(rel)[0].replace(os.sep,'/')
+        if name in sprites:
+            print(f"ERROR: image name {name} of {src} is not unique")
+            exit(1)
+
+        image = Image.open(src).convert('RGBA')
+        if args.format == 'raw' and image.getextrema()[3][0] < 0xC0:
+            print(f"ERROR: image {src} has transparent pixels, RAW sheets have no alpha")
+            exit(1)
+        sprites[name] = image
+
+    if not sprites:
+        print("ERROR: no input images")
+        exit(1)
+
+    maxWidth = maxHeight = args.max_size
+    if args.format == 'raw':
+        maxWidth = maxHeight = args.max_size & ~1    # square with even side
+
+    sheets = _run(_encodeSheets, sprites, [ (name, image.size) for name, image in sprites.items() ], maxWidth, maxHeight, args)
+    ext = ".img" if args.format == 'auto' else f".{args.format}"
+
+    atlasMap = {"sheets": [], "sprites": {}}
+    os.makedirs(args.output, exist_ok=True)
+
+    for index, (width, height, placements, format, outputBuf) in enumerate(sheets):
+
+        for ((name, (w, h)), x, y) in placements:
+            atlasMap["sprites"][name] = {"sheet": index, "x": x, "y": y, "width": w, "height": h}
+
+        fileName = f"{args.name}{index}{ext}"
+        with open(os.path.join(args.output, fileName), 'wb') as output:
+            output.write(outputBuf)
+        size = len(outputBuf)
+
+        atlasMap["sheets"].append({"file": fileName, "format": format, "width": width, "height": height, "size": size})
+        print(f"{fileName}: {format.upper()} {width}x{height}, {len(placements)} images, {size} bytes")
+
+    with open(os.path.join(args.output, f"{args.name}.json"), 'w', encoding='utf-8') as f:
+        json.dump(atlasMap, f, indent=1)
+
+    print(f"Images: {len(sprites)}, sheets: {len(sheets)}")
+
+# measures conversion speed of every luma and dither combination, on input PNGs or generated sprites
+def benchmark(args):
+
+    if args.input:
+        images = []
+        for src, _rel in expandPaths(args.input, ['.png']):
+            with Image.open(src) as image:
+                image.load()
+                images.append(image)
+    else:
+        size = (args.size, args.size)
+        sprite = Image.merge('RGBA', [
+            Image.radial_gradient('L').resize(size),
+            Image.linear_gradient('L').resize(size),
+            Image.effect_noise(size, 64),
+            Image.linear_gradient('L').resize(size).transpose(Image.Transpose.ROTATE_90) ])
+        images = [sprite] * args.count
+
+    pixels = sum(image.width * image.height for image in images)
+    print(f"Images: {len(images)}, pixels: {pixels}")
+
+    for luma in LUMA:
+        for dither in DITHER:
+            start = time.perf_counter()
+            for image in images:
+                _packRLE(_getPixels(image,luma,dither))
+            elapsed = time.perf_counter() - start
+            print(f"{luma:8} {dither:16} {len(images) / elapsed:10.0f} images/s {pixels / elapsed / 1e6:8.2f} Mpixels/s")
 
 def main():
 
@@ -273,16 +724,8 @@ def main():
         type=argparse.FileType('wb'),
         help="Output file")
 
-    # dest= is needed to handle empty parameter list, see https://bugs.python.org/issue29298
-    subparsers = optParser.add_subparsers(title="Commands",required=True, dest="command")
-
-    encode_parser = subparsers.add_parser(
-        'encode',
-        aliases=['enc'],
-        help='Encodes PNG into Fossil image format ',
-        parents=[common_options])
-    encode_parser.set_defaults(cmd_func=encode)
-    encode_parser.add_argument(
+    encode_options = argparse.ArgumentParser(add_help=False)
+    encode_options.add_argument(
         "-s","--resize",
         required=False,
         type=ResizeType(),
@@ -290,29 +733,210 @@ def main():
         metavar="WIDTHxHEIGHT",
         help="output image size (only WIDTH or xHEIGHT are also allowed)"
         )
-    encode_parser.add_argument(
+    encode_options.add_argument(
         "-f","--format",
         required=False,
         default="rle",
-        choices=['rle','raw'],
-        help="Format of the output image, default: rle")
+        choices=['rle','raw','auto'],
+        help="Format of the output image, auto writes the smaller of rle and raw, default: rle")
+    encode_options.add_argument(
+        "--cache",
+        default=os.environ.get("WAPP_IMAGE_CACHE"),
+        metavar="CACHE_DIR",
+        help="Reuse encoded images stored in CACHE_DIR, default: $WAPP_IMAGE_CACHE")
+
+    conversion_options = argparse.ArgumentParser(add_help=False)
+    conversion_options.add_argument(
+        "--luma",
+        default="average",
+        choices=list(LUMA),
+        help="Weighting of RGB channels in the gray level, default: average")
+    conversion_options.add_argument(
+        "--dither",
+        default="none",
+        choices=DITHER,
+        help="Dithering to the 4 gray levels, default: none")
+    conversion_options.add_argument(
+        "--resample",
+        default="nearest",
+        choices=list(RESAMPLE),
+        help="Resampling filter used by --resize, default: nearest")
+
+    cache_options = argparse.ArgumentParser(add_help=False)
+    cache_options.add_argument(
+        "--cache-size",
+        type=lambda s: int(s) * 1024 * 1024,
+        default=ContentCache.DEFAULT_SIZE,
+        metavar="MB",
+        help=f"Maximum size of the cache, least recently used images are evicted, default: {ContentCache.DEFAULT_SIZE >> 20}")
+
+    decode_options = argparse.ArgumentParser(add_help=False)
+    decode_options.add_argument(
+        "-f","--format",
+        required=False,
+        default="auto",
+        choices=['auto','rle','raw'],
+        help="Format of the input image, default autodetect format")
+
+    batch_options = argparse.ArgumentParser(add_help=False)
+    batch_options.add_argument(
+        "-v","--verbose",
+        action='store_true',
+        help="Verbose output")
+    batch_options.add_argument(
+        "-i","--input",
+        required=True,
+        action='extend',
+        nargs='+',
+        metavar="DIR_FILE_OR_GLOB",
+        help="Input files, dirs (processed recursively) or glob patterns. This option can be specified multiple times. "
+            "Files in dirs and patterns are filtered by extension, .png for encode, .rle, .raw and .img for decode.")
+    batch_options.add_argument(
+        "-o","--output",
+        required=True,
+        metavar="OUTPUT_DIR",
+        help="Output directory, layout of the input dirs is preserved")
+    batch_options.add_argument(
+        "-j","--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Number of worker processes, default: number of CPUs")
+
+    # dest= is needed to handle empty parameter list, see https://bugs.python.org/issue29298
+    subparsers = optParser.add_subparsers(title="Commands",required=True, dest="command")
+
+    encode_parser = subparsers.add_parser(
+        'encode',
+        aliases=['enc'],
+        help='Encodes PNG into Fossil image format ',
+        parents=[common_options,encode_options,conversion_options,cache_options])
+    encode_parser.set_defaults(cmd_func=encode)
 
     decode_parser = subparsers.add_parser(
         'decode',
         aliases=['dec'],
         help='Decodes Fossil image format to PNG',
-        parents=[common_options])
+        parents=[common_options,decode_options])
     decode_parser.set_defaults(cmd_func=decode)
-    decode_parser.add_argument(
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='Encodes/decodes many files at once using multiple processes')
+    batch_subparsers = batch_parser.add_subparsers(title="Batch commands",required=True, dest="batch_command")
+
+    batch_encode_parser = batch_subparsers.add_parser(
+        'encode',
+        aliases=['enc'],
+        help='Encodes PNG files into Fossil image format',
+        parents=[batch_options,encode_options,conversion_options,cache_options])
+    batch_encode_parser.set_defaults(cmd_func=batch,batch_func=encode)
+
+    batch_decode_parser = batch_subparsers.add_parser(
+        'decode',
+        aliases=['dec'],
+        help='Decodes Fossil image files to PNG',
+        parents=[batch_options,decode_options])
+    batch_decode_parser.set_defaults(cmd_func=batch,batch_func=decode)
+
+    atlas_parser = subparsers.add_parser(
+        'atlas',
+        help='Packs many PNG files into sprite sheets with a JSON map of image coordinates',
+        parents=[conversion_options])
+    atlas_parser.set_defaults(cmd_func=atlas)
+    atlas_parser.add_argument(
+        "-v","--verbose",
+        action='store_true',
+        help="Verbose output")
+    atlas_parser.add_argument(
+        "-i","--input",
+        required=True,
+        action='extend',
+        nargs='+',
+        metavar="DIR_FILE_OR_GLOB",
+        help="Input files, dirs (processed recursively) or glob patterns. This option can be specified multiple times.")
+    atlas_parser.add_argument(
+        "-o","--output",
+        required=True,
+        metavar="OUTPUT_DIR",
+        help="Output directory of sheets and the NAME.json map")
+    atlas_parser.add_argument(
+        "-n","--name",
+        default="atlas",
+        help="Base name of the sheets and the map, sheets are numbered, default: atlas")
+    atlas_parser.add_argument(
         "-f","--format",
-        required=False,
-        default="auto",
-        choices=['auto','rle','raw'],
-        help="Format of the input image, default autodetect format")
+        default="rle",
+        choices=['rle','raw','auto'],
+        help="Format of the sheets, default: rle")
+    atlas_parser.add_argument(
+        "--max-size",
+        type=IntRangeType(1,0xFF),
+        default=0xFF,
+        metavar="PIXELS",
+        help="Maximum width and height of a sheet, default: 255")
+    atlas_parser.add_argument(
+        "--padding",
+        type=IntRangeType(0,0xFE),
+        default=0,
+        metavar="PIXELS",
+        help="Transparent space between images, default: 0")
+
+    benchmark_parser = subparsers.add_parser(
+        'benchmark',
+        help='Measures speed of the pixel conversion with all luma and dither options')
+    benchmark_parser.set_defaults(cmd_func=benchmark)
+    benchmark_parser.add_argument(
+        "-i","--input",
+        action='extend',
+        nargs='+',
+        metavar="DIR_FILE_OR_GLOB",
+        help="PNG files, dirs or glob patterns, default: generated sprites")
+    benchmark_parser.add_argument(
+        "-n","--count",
+        type=int,
+        default=1000,
+        metavar="N",
+        help="Number of generated sprites, default: 1000")
+    benchmark_parser.add_argument(
+        "--size",
+        type=int,
+        default=64,
+        metavar="PIXELS",
+        help="Width and height of generated sprites, default: 64")
+
+    cache_parser = subparsers.add_parser(
+        'cache',
+        help='Inspects or prunes the encoded images cache')
+    cache_subparsers = cache_parser.add_subparsers(title="Cache commands",required=True, dest="cache_command")
+
+    cache_dir_options = argparse.ArgumentParser(add_help=False)
+    cache_dir_options.add_argument(
+        "--cache",
+        required=os.environ.get("WAPP_IMAGE_CACHE") is None,
+        default=os.environ.get("WAPP_IMAGE_CACHE"),
+        metavar="CACHE_DIR",
+        help="Cache directory, default: $WAPP_IMAGE_CACHE")
+
+    cache_info_parser = cache_subparsers.add_parser(
+        'info',
+        help='Prints number of entries and size of the cache',
+        parents=[cache_dir_options,cache_options])
+    cache_info_parser.set_defaults(cmd_func=cache_info)
+
+    cache_prune_parser = cache_subparsers.add_parser(
+        'prune',
+        help='Evicts least recently used entries above the maximum size',
+        parents=[cache_dir_options,cache_options])
+    cache_prune_parser.set_defaults(cmd_func=cache_prune)
+    cache_prune_parser.add_argument(
+        "-a","--all",
+        action='store_true',
+        help="Removes all entries")
 
     args = optParser.parse_args()
     args.cmd_func(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()